@@ -23,17 +23,68 @@ design. See _place().
 - Pre-existing file we did not place -> CONFLICT, left alone (ALLOW_REPLACE=1 overrides)
 
 Reads metadata via `calibredb` (handles locking + custom columns + format
-paths). Keeps its own state file (book id -> last dst) so it never writes to
+paths), or with BACKEND=sqlite straight from metadata.db opened read-only.
+Keeps its own state (book id -> last dst, plus content fingerprints; a
+snapshot and an append-only journal, see State) so it never writes to
 Calibre's metadata.db.
 
-Env: LIB, DEST, STATE (default /state/abs_paths.json), TAG (default →abs).
+Between hourly full sweeps a run only fetches books Calibre modified since
+the last watermark (see FULL_EVERY), so a quiet tick costs next to nothing.
+`--watch` keeps running and reconciles within seconds of a Calibre change
+(see watch()); without it, one pass for the CronJob.
+
+Env: LIB, DEST, STATE (default /state/abs_paths.json), TAG (default →abs),
+COMPARE (zip|md5, default zip), WORKERS (default 8), FULL_EVERY (seconds,
+default 3600), FULL=1 (force a sweep), BACKEND (calibredb|sqlite, default
+calibredb), STATE_BACKEND (json|sqlite, default json), METRICS_FILE (default
+reconcile.prom beside STATE), PUSHGATEWAY (URL, default off), ABS_URL /
+ABS_TOKEN / ABS_LIBRARY / ABS_PATH_MAP (targeted rescan, default off),
+SHARD_COUNT / SHARD_INDEX (genre-room shards, default 1 = off), MAX_MBPS /
+MAX_IOPS / THROTTLE_HOURS (copy + hash throttle, default off), PROFILE
+(cpu|mem|both, default off) / PROFILE_DIR (default profiles/ beside STATE),
+CHECKPOINT_EVERY (books, default 100; 0 = off), DURABILITY (none|file|batch,
+default none) / DURABILITY_BATCH (default 64), FUZZY_THRESHOLD (default 0.9)
+/ FUZZY_ACTION (warn|hold, default warn).
+
+`reconcile.py plan > plan.json` records what a run would do, with the file
+state it observed; `reconcile.py apply plan.json` then does exactly that,
+refusing any operation whose files changed in between (see make_plan).
+With SHARD_COUNT > 1 each pod of an Indexed Job reconciles only its own
+genre rooms and journals to its own overlay; `reconcile.py shard-merge`
+afterwards folds the overlays into the shared state (see ShardState).
+`reconcile.py state owners|collisions|orphans` queries the recorded state;
+`reconcile.py audit` sweeps the whole tree for duplicates and orphans (see audit),
+`reconcile.py links` maps every hardlink in it (see links_scan).
+reconcile_bench.py measures all of this against a synthetic library.
 """
+import argparse
+import cProfile
+import difflib
+import errno
+import fcntl
+import glob
 import hashlib
+import http.client
 import json
 import os
+import pstats
 import re
+import select
 import shutil
+import signal
+import sqlite3
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 LIB = os.environ["LIB"]
 DEST = os.environ["DEST"]
@@ -43,42 +94,1161 @@ GENRE_FIELD = os.environ.get("GENRE_FIELD", "*genre")
 # In the CWA image `/usr/bin/calibredb` is a symlink created by s6 at runtime; a
 # command-override container (no s6 init) won't have it, so point at the real binary.
 CALIBREDB = os.environ.get("CALIBREDB", "calibredb")
+# Where book metadata comes from. `calibredb` (default) pays for an interpreter
+# start and a library load every tick; `sqlite` reads LIB/metadata.db directly,
+# read-only. `reconcile.py verify-backend` diffs the two.
+BACKEND = os.environ.get("BACKEND", "calibredb")
 # DRY_RUN=1 prints the plan and writes nothing. Always dry-run before a bulk
 # session: this job creates folders and can replace files in the live tree.
 DRY = os.environ.get("DRY_RUN", "") == "1"
 # Overwriting a curated tree file with Calibre's copy is a judgement about
 # which edition is better, so it is opt-in rather than a silent side effect.
 ALLOW_REPLACE = os.environ.get("ALLOW_REPLACE", "") == "1"
-FIELDS = f"id,title,authors,series,series_index,{GENRE_FIELD},formats"
+# How _same_content fingerprints bytes when mtimes disagree. `zip` (default)
+# reads only the epub's central directory; `md5` hashes the whole file.
+COMPARE = os.environ.get("COMPARE", "zip")
+# Books compared/copied concurrently. Bounds how many NFS round trips are in
+# flight at once; operations inside one folder still run in order.
+WORKERS = max(1, int(os.environ.get("WORKERS", "8")))
+# State journal: records per fsync, and journal length that triggers folding
+# it back into the snapshot. See State.
+JOURNAL_BATCH = max(1, int(os.environ.get("JOURNAL_BATCH", "100")))
+COMPACT_AT = int(os.environ.get("COMPACT_AT", "5000"))
+# `json` (snapshot + journal) or `sqlite` (indexed; see SqliteState).
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "json")
+# Between full sweeps a run only asks Calibre for books modified since the
+# stored watermark. A sweep every FULL_EVERY seconds (or FULL=1) catches what
+# that cannot see: tree drift, hand edits, a path freed by another book.
+FULL_EVERY = int(os.environ.get("FULL_EVERY", "3600"))
+FORCE_FULL = os.environ.get("FULL", "") == "1"
+FIELDS = f"id,title,authors,series,series_index,{GENRE_FIELD},formats,last_modified"
+# Per-run cost, as a Prometheus textfile ("" disables) and/or a PUT to a
+# Pushgateway-compatible URL. See write_metrics(). Nothing scrapes the RWO
+# /state volume and the cluster runs no Pushgateway yet, so until PUSHGATEWAY
+# points at one the file is for `cat`; a Grafana dashboard belongs with the
+# change that deploys that collection.
+METRICS_FILE = os.environ.get(
+    "METRICS_FILE", os.path.join(os.path.dirname(STATE) or ".", "reconcile.prom"))
+PUSHGATEWAY = os.environ.get("PUSHGATEWAY", "")
+# --watch: seconds between metadata.db polls, and how long it must stay
+# unchanged before a pass starts.
+WATCH_POLL = float(os.environ.get("WATCH_POLL", "5"))
+WATCH_DEBOUNCE = float(os.environ.get("WATCH_DEBOUNCE", "2"))
+# Sharding across an Indexed Job: SHARD_COUNT pods, each reconciling only its
+# own genre rooms (see ShardState). SHARD_INDEX defaults to the index the
+# Indexed Job gives every pod.
+SHARD_COUNT = max(1, int(os.environ.get("SHARD_COUNT", "1")))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", os.environ.get("JOB_COMPLETION_INDEX", "0")))
+# AudiobookShelf rescan notification (off unless ABS_URL is set): base URL, an
+# admin API token, the library id, and "<our prefix>=<ABS's prefix>" when ABS
+# mounts the tree at a different path. More than SCAN_MAX folders in one
+# flush -> one library scan instead; SCAN_DEBOUNCE holds --watch flushes until
+# changes have paused; SCAN_TIMEOUT bounds each request. See ScanNotifier.
+ABS_URL = os.environ.get("ABS_URL", "")
+ABS_TOKEN = os.environ.get("ABS_TOKEN", "")
+ABS_LIBRARY = os.environ.get("ABS_LIBRARY", "")
+ABS_PATH_MAP = os.environ.get("ABS_PATH_MAP", "")
+SCAN_MAX = int(os.environ.get("SCAN_MAX", "50"))
+SCAN_DEBOUNCE = float(os.environ.get("SCAN_DEBOUNCE", "30"))
+SCAN_TIMEOUT = float(os.environ.get("SCAN_TIMEOUT", "3"))
+
+# Share of the NFS export reconcile may take for copies and hashes: MB/s and
+# I/O operations/s, 0 = unlimited. THROTTLE_HOURS ("07:00-23:00", comma-
+# separated, may wrap midnight) limits them to those local times; outside
+# them bulk work runs flat out. Empty = always. See Throttle.
+MAX_MBPS = float(os.environ.get("MAX_MBPS", "0"))
+MAX_IOPS = float(os.environ.get("MAX_IOPS", "0"))
+THROTTLE_HOURS = os.environ.get("THROTTLE_HOURS", "")
+
+# What a placed file survives: none (rename only -- a node crash can leave an
+# empty or torn epub under its final name), file (fsync each file and its
+# folder), batch (fsync DURABILITY_BATCH temp files together, rename them, then
+# fsync each folder once). See RenameBatch.
+DURABILITY = os.environ.get("DURABILITY", "none")
+DURABILITY_BATCH = max(1, int(os.environ.get("DURABILITY_BATCH", "64")))
+
+# A folder about to be created that scores FUZZY_THRESHOLD (0-1, 0 = off)
+# against an existing sibling is a likely duplicate ("The Empire Trilogy" beside
+# "Empire Trilogy"): FUZZY_ACTION=warn creates the folder anyway and says so,
+# hold leaves the book out and reports it. Warn is the default: a false hit
+# under hold is a book silently never placed. See TreeIndex.near.
+FUZZY_THRESHOLD = float(os.environ.get("FUZZY_THRESHOLD", "0.9"))
+FUZZY_ACTION = os.environ.get("FUZZY_ACTION", "warn")
+
+# Every CHECKPOINT_EVERY books a run records how far it got, so a run that is
+# evicted or killed mid-way resumes there (see _resume_point). 0 = never.
+CHECKPOINT_EVERY = int(os.environ.get("CHECKPOINT_EVERY", "100"))
+
+# PROFILE=cpu|mem|both writes a cProfile and/or tracemalloc snapshot of each
+# pass into PROFILE_DIR; `reconcile.py profile-diff` compares two. See profiling().
+PROFILE = os.environ.get("PROFILE", "")
+PROFILE_DIR = os.environ.get(
+    "PROFILE_DIR", os.path.join(os.path.dirname(STATE) or ".", "profiles"))
+
+# What this run cost: wall seconds per phase, and I/O counters. A tick that
+# takes 4 minutes instead of 10 seconds has to say whether calibredb, NFS
+# listings, hashing or copying ate the time.
+PHASES = {}
+STATS = {}
+_STATS_LOCK = threading.Lock()
+# Link counts read off the stats this run takes anyway (see _same_content):
+# tree files per st_nlink, and tree files sharing their inode with Calibre's
+# copy -- the hardlink that lets embed_metadata write into the tree.
+NLINK = {}
+CALIBRE_SHARED = {}     # dst -> st_nlink
+
+
+def count(name, n=1):
+    with _STATS_LOCK:
+        STATS[name] = STATS.get(name, 0) + n
+
+
+@contextmanager
+def phase(name):
+    """Time a block into PHASES[name]. Worker threads add up, so the compare and
+    copy phases are cumulative worker time, not wall time."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _STATS_LOCK:
+            PHASES[name] = PHASES.get(name, 0.0) + time.perf_counter() - t0
+
+
+def _stat(p):
+    count("stat")
+    return os.stat(p)
+
+
+def _exists(p):
+    try:
+        _stat(p)
+    except OSError:
+        return False
+    return True
+
+
+class Book:
+    """One tagged book, reduced to the fields reconcile reads.
+
+    A book used to stay as calibredb's dict for the whole run: a hash table
+    per book plus a `formats` list of every format's path, when only the epub
+    is ever used. With a large tagged set inside the 512Mi limit, that list
+    and the state dict were the peak. Slots and one epub path make a record
+    a fraction of the size. Author, series and genre strings are interned, so
+    a 40-book series holds its names once.
+    """
+
+    __slots__ = ("id", "title", "authors", "series", "series_index", "genre", "epub",
+                 "last_modified")
+
+    def __init__(self, rec):
+        self.id = str(rec["id"])
+        self.title = rec.get("title")
+        self.authors = _intern(rec.get("authors"))
+        self.series = _intern(rec.get("series"))
+        self.series_index = rec.get("series_index")
+        genre = rec.get(GENRE_FIELD)
+        self.genre = _intern(genre) if not isinstance(genre, list) else genre
+        self.epub = next((p for p in rec.get("formats") or []
+                          if p.lower().endswith(".epub")), None)
+        self.last_modified = rec.get("last_modified")
 
 
-def calibredb(*args):
-    return subprocess.run(
-        [CALIBREDB, "--with-library", LIB, *args],
-        capture_output=True, text=True, check=True,
-    ).stdout
+def _intern(s):
+    return sys.intern(s) if s else s
+
+
+def fetch_books(since=None, backend=None):
+    """Every `TAG` book, or only those Calibre modified on/after `since`.
+
+    Calibre's date search compares whole days, so `since` is a YYYY-MM-DD
+    cutoff; main() passes the day before the watermark. Re-seeing a day's
+    worth of books is harmless -- everything downstream is idempotent.
+    """
+    if (backend or BACKEND) == "sqlite":
+        return sqlite_books(since)
+    search = f'tag:"{TAG}"'
+    if since:
+        search += f' and last_modified:">={since}"'
+    return calibredb_books(
+        "list", "--search", search, "--fields", FIELDS, "--for-machine")
+
+
+def calibredb_books(*args):
+    """Run calibredb and parse its --for-machine JSON array book by book, as
+    it comes out of the pipe.
+
+    Reading all of stdout and then json.loads meant the whole text, then every
+    book as a dict, then the caller's records were all in memory at once. Here
+    only one pipe read (64 KiB) and the Book records are held, so peak memory
+    follows the number of books, not the size of calibredb's output.
+
+    stderr goes to a temporary file, not a second pipe: nothing reads that
+    pipe while stdout is streamed, so 64 KiB of warnings would block calibredb
+    forever.
+    """
+    errf = tempfile.TemporaryFile("w+")
+    with errf:
+        proc = subprocess.Popen([CALIBREDB, "--with-library", LIB, *args], text=True,
+                                stdout=subprocess.PIPE, stderr=errf)
+        books, buf, pos = _stream_books(proc)
+        errf.seek(0)
+        err = errf.read()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=err)
+    if buf[pos:].strip():
+        json.JSONDecoder().raw_decode(buf, pos)   # truncated output: raise the real parse error
+    return books
+
+
+def _stream_books(proc):
+    """(Book records, unparsed buffer, position) from proc's stdout, to exit."""
+    decoder = json.JSONDecoder()
+    books, buf, pos = [], "", 0
+    with proc:
+        for chunk in iter(lambda: proc.stdout.read(1 << 16), ""):
+            buf = buf[pos:] + chunk
+            pos = 0
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n[,]":
+                    pos += 1           # array punctuation between books
+                if pos == len(buf):
+                    break
+                try:
+                    rec, pos2 = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break              # this book continues in the next read
+                books.append(Book(rec))
+                pos = pos2
+    return books, buf, pos
+
+
+def _custom_column(db, key):
+    """SQL expression for custom column `*label`, resolved the way calibredb does.
+
+    Normalized columns (text, enumeration, series...) keep values in
+    custom_column_N joined through books_custom_column_N_link; the rest store
+    the value against the book directly. Multi-valued columns come back as
+    one string joined on chr(31), split by the caller.
+    """
+    row = db.execute(
+        "SELECT id, is_multiple, normalized FROM custom_columns WHERE label = ?",
+        (key.lstrip("*#"),)).fetchone()
+    if row is None:
+        return "NULL", False
+    n, multiple, normalized = int(row[0]), bool(row[1]), bool(row[2])
+    if normalized:
+        return (f"(SELECT group_concat(v.value, char(31)) FROM books_custom_column_{n}_link l"
+                f" JOIN custom_column_{n} v ON v.id = l.value WHERE l.book = b.id)"), multiple
+    return f"(SELECT value FROM custom_column_{n} WHERE book = b.id)", multiple
+
+
+def _metadata_db():
+    """Open metadata.db so that writing to it is impossible, not merely avoided.
+
+    mode=ro refuses every write at the SQLite layer. `immutable` additionally
+    skips locking -- a real saving on NFS, where every lock is a round trip --
+    but is only honest while nobody is writing, so it is used only when no
+    rollback journal or WAL exists; sqlite_books() re-checks afterwards.
+    """
+    path = os.path.join(LIB, "metadata.db")
+    busy = any(os.path.exists(path + sfx) for sfx in ("-journal", "-wal"))
+    uri = f"file:{path}?mode=ro" + ("" if busy else "&immutable=1")
+    db = sqlite3.connect(uri, uri=True)
+    db.execute("PRAGMA query_only = 1")
+    return db, not busy
+
+
+def sqlite_books(since=None):
+    """fetch_books() straight from metadata.db, read the way calibredb --for-machine is."""
+    path = os.path.join(LIB, "metadata.db")
+    before = os.stat(path)
+    db, immutable = _metadata_db()
+    try:
+        rows, multiple = _sqlite_rows(db, since)
+    finally:
+        db.close()
+    after = os.stat(path)
+    if immutable and (before.st_mtime_ns, before.st_size) != (after.st_mtime_ns, after.st_size):
+        # Calibre wrote while we read without locks: the rows may be torn.
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows, multiple = _sqlite_rows(db, since)
+        finally:
+            db.close()
+    books = []
+    for bid, title, authors, series, idx, genre, formats, bpath, modified in rows:
+        if genre is not None:
+            genre = genre.split("\x1f") if multiple else genre
+        books.append(Book({
+            "id": bid, "title": title,
+            # calibre stores ',' in author names as '|' (authors_to_string undoes it)
+            "authors": " & ".join(a.replace("|", ",") for a in (authors or "").split("\x1f") if a),
+            "series": series, "series_index": idx, GENRE_FIELD: genre,
+            "formats": [os.path.join(LIB, bpath, f) for f in (formats or "").split("\x1f") if f],
+            "last_modified": modified.replace(" ", "T", 1) if modified else None,
+        }))
+    return books
+
+
+def _sqlite_rows(db, since):
+    genre_sql, multiple = _custom_column(db, GENRE_FIELD)
+    # calibredb's tag:"x" is a case-insensitive contains, not an exact match.
+    db.create_function("tag_match", 1, lambda t: TAG.casefold() in (t or "").casefold(),
+                       deterministic=True)
+    sql = f"""
+        SELECT b.id, b.title,
+          (SELECT group_concat(name, char(31)) FROM
+             (SELECT a.name FROM books_authors_link l JOIN authors a ON a.id = l.author
+              WHERE l.book = b.id ORDER BY l.id)),
+          (SELECT s.name FROM books_series_link l JOIN series s ON s.id = l.series
+           WHERE l.book = b.id),
+          b.series_index,
+          {genre_sql},
+          (SELECT group_concat(d.name || '.' || lower(d.format), char(31)) FROM data d
+           WHERE d.book = b.id),
+          b.path, b.last_modified
+        FROM books b
+        WHERE b.id IN (SELECT l.book FROM books_tags_link l JOIN tags t ON t.id = l.tag
+                       WHERE tag_match(t.name))
+          AND (? IS NULL OR b.last_modified >= ?)
+        ORDER BY b.id"""
+    return db.execute(sql, (since, since)).fetchall(), multiple
+
+
+def verify_backend():
+    """Diff the sqlite backend against calibredb, the oracle. Exit 1 on any difference."""
+    def norm(b):
+        lm = b.last_modified
+        return {k: getattr(b, k) for k in Book.__slots__} | {
+            "series_index": float(b.series_index or 0),
+            "last_modified": datetime.fromisoformat(lm) if lm else None}
+    oracle = {b.id: norm(b) for b in fetch_books(backend="calibredb")}
+    direct = {b.id: norm(b) for b in fetch_books(backend="sqlite")}
+    bad = 0
+    for bid in sorted(oracle.keys() | direct.keys(), key=int):
+        a, b = oracle.get(bid), direct.get(bid)
+        if a is None or b is None:
+            print(f"id={bid} only in {'calibredb' if b is None else 'sqlite'}")
+            bad += 1
+            continue
+        for k in ("title", "authors", "series", "series_index", "genre", "epub",
+                  "last_modified"):
+            if a.get(k) != b.get(k):
+                print(f"id={bid} {k}: calibredb={a.get(k)!r} sqlite={b.get(k)!r}")
+                bad += 1
+    print(f"verify-backend: {len(oracle)} book(s), {bad} difference(s)")
+    return 1 if bad else 0
+
+
+_UNSAFE = re.compile(r'[/:*?"<>|]')
+_SPACES = re.compile(r"\s+")
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+_WORDS = re.compile(r"[a-z0-9]+")
+_INDEX_PREFIX = re.compile(r"^\s*\d+(?:\.\d+)?\s*-\s*(.+)$")
+_ARTICLES = {"the", "a", "an"}
 
 
 def sanitize(s):
     """Filesystem-safe, matching how the existing folders are named."""
-    s = re.sub(r'[/:*?"<>|]', "_", s)
-    return re.sub(r"\s+", " ", s).strip()
+    return _SPACES.sub(" ", _UNSAFE.sub("_", s)).strip()
+
+
+def _journal_records(path):
+    """(kind, key, value) records from a journal file, oldest first."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    return         # torn tail from a crash: nothing after it was synced
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+    except FileNotFoundError:
+        return
+
+
+def _truncate_torn(path):
+    """Cut a torn tail off a journal before anything is appended to it.
+
+    Replay stops at the torn line, and the next append would otherwise
+    continue that very line: every record written after the crash would sit
+    behind it, unreadable, on every later replay.
+    """
+    try:
+        with open(path, "rb+") as f:
+            good = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+            size = f.seek(0, os.SEEK_END)
+            if good < size:
+                print(f"WARN state: dropped a torn journal tail ({size - good} B) from {path}")
+                f.truncate(good)
+                f.flush()
+                os.fsync(f.fileno())
+    except FileNotFoundError:
+        pass
+
+
+class State:
+    """Reconcile's memory: {book id: last dst}, content fingerprints
+    ({path: [size, mtime_ns, ino, digest]}) and run metadata (watermark,
+    last_full).
+
+    Stored as a snapshot (STATE, JSON) plus an append-only journal beside it
+    (STATE.journal, one JSON record per line). Rewriting the whole snapshot
+    once at the end of a run meant an OOM-kill or job timeout lost every
+    decision the run had made, and a one-entry change still cost a full
+    serialization. Now each change is appended as it happens, fsynced every
+    JOURNAL_BATCH records, and folded into a fresh snapshot only once the
+    journal holds COMPACT_AT records. A torn last line (a crash mid-write) is
+    ignored on replay and cut off before the next append (_truncate_torn);
+    every record is an absolute set, so replaying a journal that was already
+    compacted is harmless.
+
+    Snapshots written before the journal existed -- including the bare
+    {book id: dst} map from before fingerprints -- load unchanged.
+    """
+
+    def __init__(self, path=STATE, dry=False):
+        self.path, self.dry = path, dry
+        self._lock = threading.Lock()
+        self._pending = []         # (kind, key, value) not yet durable
+        self.paths, self.fingerprints, self.meta = self._load()
+        self._tables = {"p": self.paths, "f": self.fingerprints, "m": self.meta}
+
+    def _load(self):
+        self.journal = self.path + ".journal"
+        self._records = 0          # records in the journal file
+        try:
+            with open(self.path) as f:
+                st = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            st = {}
+        if "paths" not in st:
+            st = {"paths": st}
+        tables = {"p": st["paths"], "f": st.get("fingerprints", {}), "m": st.get("meta", {})}
+        if not self.dry:
+            _truncate_torn(self.journal)
+        for kind, key, value in _journal_records(self.journal):
+            if value is None:
+                tables[kind].pop(key, None)
+            else:
+                tables[kind][key] = value
+            self._records += 1
+        return tables["p"], tables["f"], tables["m"]
+
+    def _apply(self, kind, key, value):
+        if value is None:
+            self._tables[kind].pop(key, None)
+        else:
+            self._tables[kind][key] = value
+
+    def _put(self, kind, key, value):
+        with self._lock:
+            if self._tables[kind].get(key) == value:
+                return         # unchanged: journal only what actually changed
+            self._apply(kind, key, value)
+            if self.dry:
+                return
+            self._pending.append((kind, key, value))
+            if len(self._pending) >= JOURNAL_BATCH:
+                self._flush()
+
+    def set_path(self, bid, dst):
+        self._put("p", bid, dst)
+
+    def set_fingerprint(self, path, rec):
+        self._put("f", path, rec)
+
+    def set_meta(self, key, value):
+        self._put("m", key, value)
+
+    def prune_fingerprints(self, keep):
+        for p in [p for p in self.fingerprints if p not in keep]:
+            self._put("f", p, None)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        os.makedirs(os.path.dirname(self.journal) or ".", exist_ok=True)
+        with open(self.journal, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in self._pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self._records += len(self._pending)
+        self._pending.clear()
+
+    def sync(self):
+        """Make every change so far durable; compact if the journal has grown
+        past COMPACT_AT. The watch daemon calls this after each pass."""
+        if self.dry:
+            return
+        with self._lock:
+            self._flush()
+            if self._records >= COMPACT_AT:
+                self._compact()
+
+    def close(self):
+        self.sync()
+
+    def _compact(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"paths": self.paths, "fingerprints": self.fingerprints,
+                       "meta": self.meta}, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        os.remove(self.journal)    # a crash before this only means a redundant replay
+        self._records = 0
+
+    def owns(self, b):
+        """Is book `b` this process's to reconcile? Always, unless sharded."""
+        return True
+
+    def owners(self, path):
+        """(book id, dst) for every book recorded at `path` or anywhere under it."""
+        path = os.path.normpath(path)
+        return sorted((b, d) for b, d in self.paths.items()
+                      if d == path or d.startswith(path + os.sep))
+
+    def collisions(self):
+        """{dst: [book ids]} for every dst recorded against more than one book."""
+        by_dst = {}
+        for b, d in self.paths.items():
+            by_dst.setdefault(d, []).append(b)
+        return {d: sorted(bs) for d, bs in sorted(by_dst.items()) if len(bs) > 1}
+
+    def orphans(self, missing=False, tagged=None):
+        """[(why, book id, dst)] for every recorded book that is no longer tagged
+        -- per the last full sweep's `untagged` list, or against the `tagged` ids
+        if given -- and with `missing`, every recorded dst gone from disk. None
+        if no tagged set is given and no sweep has recorded one."""
+        if tagged is not None:
+            untagged = {b for b in self.paths if b not in tagged}
+        elif self.meta.get("untagged") is not None:
+            untagged = set(self.meta["untagged"])
+        else:
+            return None
+        out = []
+        for bid, dst in sorted(self.paths.items()):
+            if bid in untagged:
+                out.append(("untagged", bid, dst))
+            elif missing and not os.path.lexists(dst):
+                out.append(("missing", bid, dst))
+        return out
+
+
+class SqliteState(State):
+    """State in SQLite (STATE_BACKEND=sqlite), with dst indexed.
+
+    The JSON state is a flat {book id: dst} map, so "which book owns this
+    path?" or "which paths are orphaned?" is a linear scan, which is what kept
+    collisions and left-behind tree files invisible. Here the same records sit
+    in indexed tables and `reconcile.py state ...` answers in milliseconds on
+    a 50k-book library. A run still works from in-memory dicts loaded at
+    start; changes are committed every JOURNAL_BATCH records, so progress
+    survives a crash the same way the journal's does. Those queries load
+    nothing: loading 50k books and 100k fingerprints costs a thousand times
+    the indexed lookup, so they run on reader() instead.
+
+    The database lives beside STATE (abs_paths.json -> abs_paths.db) and is
+    seeded from the JSON snapshot + journal the first time it is opened.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS books (book_id TEXT PRIMARY KEY, dst TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS books_dst ON books (dst);
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, ino INTEGER, digest TEXT);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    @classmethod
+    def reader(cls, path=STATE):
+        """A read-only SqliteState that skips _load, for `reconcile.py state`:
+        paths, fingerprints and meta are never read into memory, so only
+        owners, collisions and orphans work on it. None if the database does
+        not exist yet."""
+        self = cls.__new__(cls)
+        self.path, self.dry = path, True
+        self.db_path = os.path.splitext(path)[0] + ".db"
+        if not os.path.exists(self.db_path):
+            return None
+        self._lock, self._pending = threading.Lock(), []
+        self._open()
+        return self
+
+    def _load(self):
+        self.db_path = os.path.splitext(self.path)[0] + ".db"
+        if not os.path.exists(self.db_path):
+            legacy = State(self.path, dry=True)
+            self.db = None
+            if not self.dry:
+                self._open()
+                self._write([("p", k, v) for k, v in legacy.paths.items()]
+                            + [("f", k, v) for k, v in legacy.fingerprints.items()]
+                            + [("m", k, v) for k, v in legacy.meta.items()])
+            return legacy.paths, legacy.fingerprints, legacy.meta
+        self._open()
+        return (dict(self.db.execute("SELECT book_id, dst FROM books")),
+                {p: list(rec) for p, *rec in self.db.execute(
+                    "SELECT path, size, mtime_ns, ino, digest FROM fingerprints")},
+                {k: json.loads(v) for k, v in self.db.execute("SELECT key, value FROM meta")})
+
+    def _open(self):
+        if self.dry:
+            self.db = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True,
+                                      check_same_thread=False)
+            return
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def _write(self, records):
+        with self.db:
+            for kind, key, value in records:
+                if kind == "p":
+                    if value is None:
+                        self.db.execute("DELETE FROM books WHERE book_id = ?", (key,))
+                    else:
+                        self.db.execute("INSERT OR REPLACE INTO books VALUES (?, ?)", (key, value))
+                elif kind == "f":
+                    if value is None:
+                        self.db.execute("DELETE FROM fingerprints WHERE path = ?", (key,))
+                    else:
+                        self.db.execute(
+                            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)",
+                            (key, *value))
+                elif value is None:
+                    self.db.execute("DELETE FROM meta WHERE key = ?", (key,))
+                else:
+                    self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                    (key, json.dumps(value)))
+
+    def _flush(self):
+        if self._pending:
+            self._write(self._pending)
+            self._pending.clear()
 
+    def sync(self):
+        if not self.dry:
+            with self._lock:
+                self._flush()
 
-def load_state():
+    def close(self):
+        self.sync()
+        if self.db is not None:
+            self.db.close()
+
+    def owners(self, path):
+        if self.db is None:          # not migrated yet (read-only open): scan the dicts
+            return super().owners(path)
+        path = os.path.normpath(path)
+        # dst range scan on the index: every dst that starts with "<path>/".
+        # ("0" is the character after os.sep, so the range is exactly that prefix.)
+        return self.db.execute(
+            "SELECT book_id, dst FROM books WHERE dst = ? OR (dst >= ? AND dst < ?) "
+            "ORDER BY book_id", (path, path + os.sep, path + "0")).fetchall()
+
+    def collisions(self):
+        if self.db is None:
+            return super().collisions()
+        out = {}
+        for dst, bid in self.db.execute(
+                "SELECT dst, book_id FROM books WHERE dst IN "
+                "(SELECT dst FROM books GROUP BY dst HAVING count(*) > 1) ORDER BY dst, book_id"):
+            out.setdefault(dst, []).append(bid)
+        return out
+
+    def orphans(self, missing=False, tagged=None):
+        if self.db is None:
+            return super().orphans(missing, tagged)
+        if tagged is not None:
+            cond = "book_id NOT IN (SELECT value FROM json_each(?))"
+            args = [json.dumps(list(tagged))]
+        elif self.db.execute("SELECT 1 FROM meta WHERE key = 'untagged'").fetchone():
+            cond, args = ("book_id IN (SELECT value FROM json_each("
+                          "(SELECT value FROM meta WHERE key = 'untagged')))"), []
+        else:
+            return None
+        if not missing:        # the primary key answers it alone
+            return [("untagged", bid, dst) for bid, dst in self.db.execute(
+                f"SELECT book_id, dst FROM books WHERE {cond} ORDER BY book_id", args)]
+        out = []
+        for bid, dst, untagged in self.db.execute(
+                f"SELECT book_id, dst, {cond} FROM books ORDER BY book_id", args):
+            if untagged:
+                out.append(("untagged", bid, dst))
+            elif not os.path.lexists(dst):
+                out.append(("missing", bid, dst))
+        return out
+
+
+class ShardState(State):
+    """One shard's state: the shared state, read-only, with this shard's own
+    changes layered on top (SHARD_COUNT > 1).
+
+    Shards run side by side, so none of them may write the shared state.
+    Each one journals its changes to an overlay beside STATE
+    (abs_paths.shard<i>of<n>.journal). The shared state has every room's
+    history. The overlay adds what this shard has done since the last
+    `reconcile.py shard-merge`, which folds all overlays back in. Overlays are
+    never compacted, and fingerprints are never pruned here: a shard sees only
+    its own rooms, so it cannot tell which fingerprints are dead.
+
+    Rooms go to shards greedily, largest first, by how many books the shared
+    state files under each. So the split changes only at a merge, when no
+    overlay is left to disagree with it. A room the shared state has not seen
+    yet falls back to a CRC of its name.
+    """
+
+    def __init__(self, dry=False):
+        self.base = _base_state(dry=True)
+        stem = os.path.splitext(STATE)[0]
+        for other in glob.glob(glob.escape(stem) + ".shard*of*.journal"):
+            if not other.endswith(f"of{SHARD_COUNT}.journal"):
+                sys.exit(f"{other}: overlay from another SHARD_COUNT; "
+                         f"run `reconcile.py shard-merge` first")
+        super().__init__(path=f"{stem}.shard{SHARD_INDEX}of{SHARD_COUNT}.journal", dry=dry)
+        sizes = {}
+        for dst in self.base.paths.values():
+            room = os.path.relpath(dst, DEST).split(os.sep)[0]
+            sizes[room] = sizes.get(room, 0) + 1
+        load = [0] * SHARD_COUNT
+        self.rooms = {}
+        for room in sorted(sizes, key=lambda r: (-sizes[r], r)):
+            i = load.index(min(load))
+            self.rooms[room] = i
+            load[i] += sizes[room]
+
+    def _load(self):
+        self.journal = self.path        # the overlay is journal-only
+        self._records = 0
+        tables = {"p": dict(self.base.paths), "f": dict(self.base.fingerprints),
+                  "m": dict(self.base.meta)}
+        if not self.dry:
+            _truncate_torn(self.journal)
+        for kind, key, value in _journal_records(self.journal):
+            if value is None:
+                tables[kind].pop(key, None)
+            else:
+                tables[kind][key] = value
+        return tables["p"], tables["f"], tables["m"]
+
+    def owns(self, b):
+        room = sanitize(b.genre or "")
+        shard = self.rooms.get(room)
+        if shard is None:
+            shard = zlib.crc32(room.encode()) % SHARD_COUNT
+        return shard == SHARD_INDEX
+
+    def prune_fingerprints(self, keep):
+        pass                  # shard-merge prunes, once every shard has swept
+
+    def sync(self):
+        if not self.dry:
+            with self._lock:
+                self._flush()
+
+    def close(self):
+        self.sync()
+        self.base.close()
+
+
+def _base_state(dry=False):
+    return (SqliteState if STATE_BACKEND == "sqlite" else State)(dry=dry)
+
+
+def open_state(dry=False):
+    return ShardState(dry=dry) if SHARD_COUNT > 1 else _base_state(dry=dry)
+
+
+def open_query():
+    """Read-only state for `reconcile.py state`. An existing SQLite database is
+    queried where it lies (SqliteState.reader); JSON state, and shard overlays
+    that must be replayed over the base, are loaded as for a dry run."""
+    if STATE_BACKEND == "sqlite" and SHARD_COUNT == 1:
+        reader = SqliteState.reader()
+        if reader is not None:
+            return reader
+    return open_state(dry=True)
+
+
+def shard_merge():
+    """`reconcile.py shard-merge`: fold every shard overlay into the shared state.
+
+    Run once the Indexed Job has finished, never alongside it. Book paths and
+    fingerprints are replayed in shard order. Each shard's rooms are its own,
+    so the overlays do not overlap. The watermark and last_full become the
+    OLDEST across all SHARD_COUNT shards. A shard that crashed, or never ran,
+    holds them back, and its books are fetched again next time. Once every
+    shard has swept since the last merge, fingerprints of files that no
+    longer exist are pruned. The partnership index is rebuilt last.
+    """
+    stem = os.path.splitext(STATE)[0]
+    overlays = {}
+    for p in glob.glob(glob.escape(stem) + ".shard*of*.journal"):
+        i, n = map(int, re.search(r"\.shard(\d+)of(\d+)\.journal$", p).groups())
+        overlays[i, n] = p
+    layouts = {n for _, n in overlays}
+    if len(layouts) > 1:
+        print(f"shard-merge: overlays from several SHARD_COUNTs {sorted(layouts)}; "
+              f"merge by hand", file=sys.stderr)
+        return 2
+    state = _base_state()
     try:
-        with open(STATE) as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+        if overlays:
+            n = layouts.pop()
+            metas = []
+            for i in range(n):
+                meta = {}
+                for kind, key, value in _journal_records(overlays.get((i, n), "")):
+                    if kind == "m":
+                        meta[key] = value
+                    else:
+                        state._put(kind, key, value)
+                metas.append(meta)
+            last_full = state.meta.get("last_full")
+            for key, order in (("watermark", datetime.fromisoformat), ("last_full", float)):
+                values = [m.get(key, state.meta.get(key)) for m in metas]
+                if None not in values:
+                    state.set_meta(key, min(values, key=order))
+            swept = state.meta.get("last_full") != last_full    # every shard swept since
+            if swept:
+                state.prune_fingerprints({p for p in state.fingerprints if os.path.lexists(p)})
+                # Every shard saw every tagged book; a book is untagged only if
+                # no shard saw it tagged and it is still recorded.
+                lists = [set(m["untagged"]) for m in metas if "untagged" in m]
+                if lists:
+                    state.set_meta("untagged", sorted(set.intersection(*lists) & set(state.paths)))
+            print(f"shard-merge: {len(overlays)} overlay(s) from {n} shard(s) merged"
+                  f"{' (fingerprints pruned)' if swept else ''}")
+        state.sync()
+    finally:
+        state.close()
+    for p in overlays.values():
+        os.remove(p)
+    _write_partners(_scan_partners())
+    return 0
 
 
-def save_state(st):
-    os.makedirs(os.path.dirname(STATE) or ".", exist_ok=True)
-    tmp = STATE + ".tmp"
-    with open(tmp, "w") as f:
-        json.dump(st, f, indent=2, ensure_ascii=False)
-    os.replace(tmp, STATE)
+def state_command(args):
+    """`reconcile.py state owners <path> | collisions | orphans [--missing]`."""
+    state = open_query()
+    try:
+        if args.what == "owners":
+            rows = state.owners(args.path)
+            for bid, dst in rows:
+                print(f"{bid}\t{dst}")
+            return 0 if rows else 1
+        if args.what == "collisions":
+            found = state.collisions()
+            for dst, bids in found.items():
+                print(f"{','.join(bids)}\t{dst}")
+            return 1 if found else 0
+        # orphans: recorded books that are no longer tagged (their tree file was
+        # left behind), and with --missing, recorded paths gone from disk. The
+        # last full sweep recorded which books were untagged, so this needs no
+        # calibredb start; only a state no sweep has written yet asks Calibre.
+        rows = state.orphans(args.missing)
+        if rows is None:
+            print("state orphans: no full sweep has recorded the tagged set yet; "
+                  "asking Calibre", file=sys.stderr)
+            rows = state.orphans(args.missing, tagged={b.id for b in fetch_books()})
+        for why, bid, dst in rows:
+            print(f"{why}\t{bid}\t{dst}")
+        return 1 if rows else 0
+    finally:
+        state.close()
+
+
+def _walk_room(room):
+    """Every epub (and leftover temp file) under DEST/room, plus its empty folders.
+
+    One scandir per folder and nothing kept but a compact tuple per file --
+    (path relative to DEST, size, mtime_ns, inode, nlink) -- so a 100k-file
+    tree costs a few tens of MB, not a DirEntry or stat_result per file.
+    """
+    files, empty, stack = [], [], [os.path.join(DEST, room)]
+    while stack:
+        d = stack.pop()
+        count("scandir")
+        try:
+            it = os.scandir(d)
+        except OSError as e:
+            print(f"WARN   audit: {d}: {e}", file=sys.stderr)
+            continue
+        n = 0
+        with it:
+            for e in it:
+                n += 1
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.name.lower().endswith((".epub", ".reconcile.tmp")):
+                    st = e.stat(follow_symlinks=False)
+                    files.append((os.path.relpath(e.path, DEST), st.st_size,
+                                  st.st_mtime_ns, st.st_ino, st.st_nlink))
+        if not n:
+            empty.append(os.path.relpath(d, DEST))
+    return files, empty
+
+
+def _audit_key(rel):
+    """Normalized author, series and title of a tree epub, from its folders, as
+    one NUL-joined string (a tuple of three costs twice the memory at 100k).
+
+    <Genre>/<Author>/[<Series>/]<NN - Title>/<file>: the genre is left out so
+    the same book shelved in two rooms still groups together. None for a file
+    that does not sit at book-folder depth.
+    """
+    parts = rel.split(os.sep)
+    if len(parts) not in (4, 5):
+        return None
+    m = _INDEX_PREFIX.match(parts[-2])
+    title = m.group(1) if m else parts[-2]
+    return "\0".join((_norm(parts[1]), _norm(parts[2]) if len(parts) == 5 else "",
+                      _norm(title)))
+
+
+def audit(jobs=1, content=True, unowned=False):
+    """`reconcile.py audit`: one read-only pass over DEST, as a JSON report.
+
+    A run only ever looks at the paths its books resolve to, so nothing it does
+    notices what accumulates beside them: the same book in two rooms or under
+    two spellings of its author, one epub copied into two folders, a recorded
+    path somebody deleted, two book ids that reach the same file (one path, or
+    one inode under two paths), crash debris from _place. This walks the whole
+    tree once -- per genre room, `jobs` rooms at a time -- and reports:
+
+    - duplicate_titles: one normalized (author, series, title) in more than
+      one folder;
+    - duplicate_content: one fingerprint in more than one inode. Only files
+      whose SIZE matches another's are digested (a unique size cannot have a
+      twin), one size at a time, and fingerprints already cached in the state
+      are reused, so the pass reads bytes for a handful of files, not the
+      whole tree;
+    - missing: recorded paths no longer on disk;
+    - shared: files reachable from more than one book id;
+    - unowned: tree epubs no book id owns (curated files, mostly -- counted,
+      listed only with `unowned`);
+    - temp_files and empty_folders: what interrupted runs and hand moves leave.
+
+    Read-only: the state is opened dry and digests taken here are not kept.
+    Exit status 1 when anything but the unowned count is non-empty.
+    """
+    state = open_state(dry=True)
+    try:
+        with os.scandir(DEST) as it:
+            rooms = sorted(e.name for e in it if e.is_dir(follow_symlinks=False))
+        with ThreadPoolExecutor(max(1, jobs)) as pool:
+            walked = list(pool.map(_walk_room, rooms))
+        epubs, temps, empty = [], [], []
+        for files, folders in walked:
+            empty += folders
+            for rec in files:
+                (temps if rec[0].endswith(".reconcile.tmp") else epubs).append(rec)
+        del walked
+
+        # First path per key, and lists only for keys seen twice: nearly every
+        # key is unique, and a list per key would double this index.
+        first, twice = {}, {}
+        for rec in epubs:
+            key = _audit_key(rec[0])
+            if key is None:
+                continue
+            if key in first:
+                twice.setdefault(key, [first[key]]).append(rec[0])
+            else:
+                first[key] = rec[0]
+        del first
+        dup_titles = []
+        for key, ps in twice.items():
+            if len({os.path.dirname(p) for p in ps}) > 1:
+                author, series, title = key.split("\0")
+                dup_titles.append({"author": author, "series": series, "title": title,
+                                   "paths": sorted(ps)})
+
+        dup_content, hashed = [], 0
+        if content:
+            by_size, inodes = {}, set()
+            for rec in epubs:
+                if rec[3] not in inodes:      # a hardlink is one file, not a copy
+                    inodes.add(rec[3])
+                    by_size.setdefault(rec[1], []).append(rec)
+            del inodes
+            want = _DIGEST_KINDS[COMPARE]
+            for recs in by_size.values():
+                if len(recs) < 2:
+                    continue
+                # Twins share a size, so digests only need comparing inside
+                # one bucket: memory is bounded by the largest bucket.
+                got = []        # [rel, digest, taken from the state's cache]
+                for rel, size, mtime_ns, ino, _ in recs:
+                    rec = state.fingerprints.get(os.path.join(DEST, rel))
+                    ok = rec and rec[:3] == [size, mtime_ns, ino] and rec[3].startswith(want)
+                    got.append([rel, rec[3] if ok else None, bool(ok)])
+                for again in (False, True):
+                    for g in got:
+                        if g[1] is None:
+                            try:
+                                g[1] = _digest(os.path.join(DEST, g[0]))
+                                hashed += 1
+                            except OSError as e:
+                                print(f"WARN   audit: {g[0]}: {e}", file=sys.stderr)
+                                g[1] = ""
+                    # A cached md5: beside a zip: means COMPARE was switched;
+                    # equal bytes would split in two. Take the cached ones afresh.
+                    if again or len({_kind(d) for _, d, _ in got if d}) < 2:
+                        break
+                    for g in got:
+                        if g[2]:
+                            g[1], g[2] = None, False
+                by_digest = {}
+                for rel, digest, _ in got:
+                    if digest:
+                        by_digest.setdefault(digest, []).append(rel)
+                dup_content += [{"fingerprint": d, "paths": sorted(ps)}
+                                for d, ps in by_digest.items() if len(ps) > 1]
+            del by_size
+
+        owners = {}
+        for bid, dst in state.paths.items():
+            owners.setdefault(os.path.relpath(dst, DEST), []).append(bid)
+        present, by_inode, loose = set(), {}, []
+        for rel, _, _, ino, _ in epubs:
+            if rel in owners:
+                present.add(rel)
+                by_inode.setdefault(ino, []).append(rel)
+            else:
+                loose.append(rel)
+        missing = sorted(((b, os.path.join(DEST, rel)) for rel, bids in owners.items()
+                          if rel not in present for b in bids), key=lambda r: r[1])
+        shared = []
+        for rels in by_inode.values():
+            bids = sorted({b for rel in rels for b in owners[rel]})
+            if len(bids) > 1:
+                shared.append({"books": bids, "paths": sorted(rels)})
+
+        report = {
+            "dest": DEST, "rooms": len(rooms), "epubs": len(epubs),
+            "digested": hashed,
+            "duplicate_titles": sorted(dup_titles, key=lambda r: r["paths"][0]),
+            "duplicate_content": sorted(dup_content, key=lambda r: r["paths"][0]),
+            "missing": [{"book": b, "path": p} for b, p in missing],
+            "shared": sorted(shared, key=lambda r: r["paths"][0]),
+            "unowned": len(loose),
+            "temp_files": sorted(rec[0] for rec in temps),
+            "empty_folders": sorted(empty),
+        }
+        if unowned:
+            report["unowned_paths"] = sorted(loose)
+    finally:
+        state.close()
+    json.dump(report, sys.stdout, indent=1, ensure_ascii=False)
+    print()
+    print(f"audit: {len(epubs)} epubs in {len(rooms)} rooms ({STATS.get('scandir', 0)} "
+          f"scandir, {hashed} digested): {len(dup_titles)} duplicate titles, "
+          f"{len(dup_content)} duplicate contents, {len(missing)} missing, "
+          f"{len(shared)} shared, {len(loose)} unowned, {len(temps)} temp files, "
+          f"{len(empty)} empty folders", file=sys.stderr)
+    found = dup_titles or dup_content or missing or shared or temps or empty
+    return 1 if found else 0
+
+
+def _walk_links(top, deep=True):
+    """Files under `top` per st_nlink, and (dev, inode, nlink, path) of every
+    multiply-linked one. Only those are kept: a singly-linked file cannot
+    share anything, so memory follows the links, not the tree."""
+    hist, found, stack = {}, [], [top]
+    while stack:
+        d = stack.pop()
+        count("scandir")
+        try:
+            it = os.scandir(d)
+        except OSError as e:
+            print(f"WARN   links: {d}: {e}", file=sys.stderr)
+            continue
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if deep:
+                        stack.append(e.path)
+                elif e.is_file(follow_symlinks=False):
+                    st = e.stat(follow_symlinks=False)
+                    hist[st.st_nlink] = hist.get(st.st_nlink, 0) + 1
+                    if st.st_nlink > 1:
+                        found.append((st.st_dev, st.st_ino, st.st_nlink, e.path))
+    return hist, found
+
+
+def links_scan(roots=(), jobs=1, min_nlink=3):
+    """`reconcile.py links [root ...]`: every hardlink in the export, as an
+    inode -> paths map in JSON.
+
+    The copy-not-link cleanup was verified by hand ("0 files at nlink>=3"):
+    a find per root, then matching inodes up by eye. This walks DEST, LIB and
+    any extra roots (the torrent download folder, say) once, each top-level
+    folder on its own worker, and groups multiply-linked files by inode.
+
+    A group is reported when its nlink reaches `min_nlink` -- a tree file's
+    torrent partner alone makes 2, which is expected -- or whenever it joins
+    a Calibre path to a tree path, which is never expected. `outside` counts
+    the links not found under any scanned root. Exit status 1 when any group
+    is reported.
+    """
+    roots = [os.path.abspath(r) for r in (DEST, LIB, *roots)]
+    units = []
+    for root in roots:
+        units.append((root, False))              # the root's own files
+        try:
+            with os.scandir(root) as it:
+                units += [(e.path, True) for e in it if e.is_dir(follow_symlinks=False)]
+        except OSError as e:
+            print(f"WARN   links: {root}: {e}", file=sys.stderr)
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        walked = list(pool.map(lambda u: _walk_links(*u), units))
+
+    hist, by_inode = {}, {}
+    for h, found in walked:
+        for n, c in h.items():
+            hist[n] = hist.get(n, 0) + c
+        for dev, ino, n, p in found:
+            by_inode.setdefault((dev, ino), [n]).append(p)
+    del walked
+    def under(p, root):
+        return p == root or p.startswith(root.rstrip(os.sep) + os.sep)
+
+    lib, dest = os.path.abspath(LIB), os.path.abspath(DEST)
+    groups = []
+    for (dev, ino), (n, *paths) in by_inode.items():
+        paths = sorted(set(paths))       # nested roots see one path twice
+        calibre = (any(under(p, lib) for p in paths)
+                   and any(under(p, dest) and not under(p, lib) for p in paths))
+        if n >= min_nlink or calibre:
+            groups.append({"inode": ino, "nlink": n, "outside": n - len(paths),
+                           "calibre": calibre, "paths": paths})
+    groups.sort(key=lambda g: (not g["calibre"], -g["nlink"], g["paths"][0]))
+    json.dump({"roots": roots, "files": sum(hist.values()),
+               "nlink": {str(n): c for n, c in sorted(hist.items())},
+               "groups": groups}, sys.stdout, indent=1, ensure_ascii=False)
+    print()
+    shared = sum(g["calibre"] for g in groups)
+    print(f"links: {sum(hist.values())} files in {len(roots)} roots ({STATS.get('scandir', 0)} "
+          f"scandir): {len(by_inode)} multiply-linked inodes, {len(groups)} reported "
+          f"({shared} shared with Calibre)", file=sys.stderr)
+    return 1 if groups else 0
 
 
 def _norm(s):
@@ -88,7 +1258,23 @@ def _norm(s):
     'Beyond The Veil' vs 'Beyond the Veil', 'as Told by the Boys' vs
     'As Told By The Boys'. Exact comparison would call these different books.
     """
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+    return _NON_ALNUM.sub("", (s or "").lower())
+
+
+def _fuzzy_key(name):
+    """_norm for similarity: index prefix and articles dropped as well."""
+    m = _INDEX_PREFIX.match(name)
+    words = _WORDS.findall((m.group(1) if m else name).lower())
+    return "".join(w for w in words if w not in _ARTICLES) or "".join(words)
+
+
+def _numbers(name):
+    """The numbers in a folder name, its index prefix first (None if it has
+    none), then every digit run in the rest, as ints so '02' is 2."""
+    m = _INDEX_PREFIX.match(name)
+    idx = float(name.split("-", 1)[0]) if m else None
+    return idx, [int(w) for w in _WORDS.findall((m.group(1) if m else name).lower())
+                 if w.isdigit()]
 
 
 def _index_prefix(b):
@@ -101,34 +1287,192 @@ def _index_prefix(b):
     why an existing folder always wins over this.
     """
     try:
-        f = float(b.get("series_index") or 0)
+        f = float(b.series_index or 0)
     except (TypeError, ValueError):
         f = 0.0
     return f"{int(f):02d}" if f == int(f) else f"{f:g}"
 
 
+class TreeIndex:
+    """What DEST looks like, read once per directory per run.
+
+    Every book used to resolve its path with fresh listdir()/isdir() probes:
+    _author_dir, a listdir of DEST plus an isdir per genre room for the
+    partnership check, and two _match_child listings that stat'ed every entry.
+    On the NFS export that is thousands of round trips per tick for answers
+    that almost never change between books. Each directory is now listed once
+    with os.scandir -- whose d_type already says file-or-folder, so no per-entry
+    stat -- and every later question about it is answered from memory.
+
+    The index is only trustworthy because reconcile is the tree's one writer
+    during a run, and plan() records each change it decides on (add_dirs,
+    added, drop_file) before execution carries it out.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything; the next question lists afresh. A full sweep starts
+        here, which is how the watch daemon picks up changes made by hand."""
+        self._dirs = {}      # abs dir -> {name: is_dir}
+        self._missing = set()   # abs paths known not to be listable folders
+        self._titles = {}    # (abs dir, want_dir) -> {_norm(title): name}
+
+    @staticmethod
+    def _key(p):
+        return os.path.normpath(p)
+
+    def entries(self, d):
+        """{name: is_dir} of folder d, or None if d is not one.
+
+        Most probes that come back empty-handed are for folders that do not
+        exist: the joined "A & B" author form in each room, the series folder
+        of a book not filed yet. NFS rarely caches a negative lookup, so each
+        would be a round trip -- but the parent's listing, usually already
+        held, says d is absent. Such paths go into _missing, and only a
+        folder reconcile itself creates (added) takes one out again.
+        """
+        d = self._key(d)
+        if d in self._dirs:
+            count("tree_hits")
+            return self._dirs[d]
+        parent, name = os.path.split(d)
+        listing = self._dirs.get(parent)
+        if d in self._missing or parent in self._missing or (
+                listing is not None and not listing.get(name)):
+            self._missing.add(d)
+            count("probes_saved")
+            return None
+        count("scandir")
+        try:
+            with os.scandir(d) as it:
+                self._dirs[d] = {e.name: e.is_dir() for e in it}
+        except OSError:
+            self._missing.add(d)
+            return None
+        return self._dirs[d]
+
+    def lexists(self, p):
+        parent, name = os.path.split(self._key(p))
+        return name in (self.entries(parent) or {})
+
+    def isdir(self, p):
+        parent, name = os.path.split(self._key(p))
+        return bool((self.entries(parent) or {}).get(name))
+
+    def subdirs(self, d):
+        return sorted(n for n, is_dir in (self.entries(d) or {}).items() if is_dir)
+
+    def match(self, parent_abs, title, want_dir=True):
+        """The normalized-title -> name map for one directory, built on first use.
+
+        Built in sorted order and first-wins, so the answer is the same entry the
+        old sorted(listdir()) scan would have stopped at.
+        """
+        key = (self._key(parent_abs), want_dir)
+        titles = self._titles.get(key)
+        if titles is None:
+            titles = {}
+            for e, is_dir in sorted((self.entries(key[0]) or {}).items()):
+                if want_dir and not is_dir:
+                    continue
+                if not want_dir and not e.lower().endswith(".epub"):
+                    continue
+                name = e if want_dir else os.path.splitext(e)[0]
+                m = _INDEX_PREFIX.match(name)
+                titles.setdefault(_norm(m.group(1) if m else name), e)
+            self._titles[key] = titles
+        return titles.get(_norm(title))
+
+    def near(self, parent_abs, name):
+        """(sibling folder, score) for the folder under parent_abs most like
+        `name`, if it scores at least FUZZY_THRESHOLD; else None.
+
+        match() answers the exact question in O(1). This one is linear in the
+        folder, so it is asked only when a folder is about to be created (see
+        _near_miss), never on the steady-state path. Scoring is difflib's
+        ratio over _fuzzy_key, which ignores case, punctuation, index prefixes
+        and articles: "The Empire Trilogy" and "Empire Trilogy" score 1.0, a
+        transposed letter about 0.9, "Dragon" against "Dragon Song" 0.75.
+
+        A score is only a spelling difference, and in a series one digit IS
+        the difference: "Book 2" beside "Book 1", "Defiance of the Fall 2"
+        beside "01 - Defiance of the Fall" are distinct volumes. So a sibling
+        whose numbers differ -- the digits in its title, or both index
+        prefixes -- is never near, whatever it scores.
+        """
+        want = _fuzzy_key(name)
+        idx, nums = _numbers(name)
+        best = None
+        for entry in self.subdirs(parent_abs):
+            e_idx, e_nums = _numbers(entry)
+            if e_nums != nums or (idx is not None and e_idx is not None and e_idx != idx):
+                continue
+            sm = difflib.SequenceMatcher(None, want, _fuzzy_key(entry))
+            if sm.real_quick_ratio() < FUZZY_THRESHOLD or sm.quick_ratio() < FUZZY_THRESHOLD:
+                continue
+            score = sm.ratio()
+            if score >= FUZZY_THRESHOLD and (best is None or score > best[1]):
+                best = (entry, score)
+        return best
+
+    def added(self, p, is_dir):
+        p = self._key(p)
+        parent, name = os.path.split(p)
+        if self._dirs.get(parent) is not None:
+            self._dirs[parent][name] = is_dir
+        self._titles.pop((parent, True), None)
+        self._titles.pop((parent, False), None)
+        if is_dir:
+            self._missing.discard(p)
+            self._dirs.setdefault(p, {})   # we just created it: known empty
+
+    def removed(self, p):
+        p = self._key(p)
+        parent, name = os.path.split(p)
+        if self._dirs.get(parent) is not None:
+            self._dirs[parent].pop(name, None)
+        self._titles.pop((parent, True), None)
+        self._titles.pop((parent, False), None)
+        self._dirs.pop(p, None)
+
+    def add_dirs(self, d):
+        """Record d and any missing ancestors as folders (the plan will create them)."""
+        d = self._key(d)
+        missing = []
+        while d and not self.isdir(d) and os.path.dirname(d) != d:
+            missing.append(d)
+            d = os.path.dirname(d)
+        for m in reversed(missing):
+            self.added(m, True)
+
+    def drop_file(self, p):
+        """Record p's removal and the upward prune _remove_stale will do.
+
+        Mirrors os.removedirs: every folder the removal leaves empty goes too.
+        The grandparent is listed first so the vanished folder cannot reappear
+        from a later, pre-removal scandir.
+        """
+        p = self._key(p)
+        self.removed(p)
+        d = os.path.dirname(p)
+        while os.path.dirname(d) != d and self.entries(d) == {}:
+            self.entries(os.path.dirname(d))
+            self.removed(d)
+            d = os.path.dirname(d)
+
+
+TREE = TreeIndex()
+
+
 def _match_child(parent_abs, title, want_dir=True):
     """Return the existing child of parent_abs whose name means `title`, else None.
 
     Book folders are '<index> - <Title>'; the index prefix is stripped before
     comparing so a differing prefix never masks a book we already own.
     """
-    want = _norm(title)
-    try:
-        entries = sorted(os.listdir(parent_abs))
-    except OSError:
-        return None
-    for e in entries:
-        full = os.path.join(parent_abs, e)
-        if want_dir and not os.path.isdir(full):
-            continue
-        if not want_dir and not e.lower().endswith(".epub"):
-            continue
-        name = e if want_dir else os.path.splitext(e)[0]
-        m = re.match(r"^\s*\d+(?:\.\d+)?\s*-\s*(.+)$", name)
-        if _norm(m.group(1) if m else name) == want:
-            return e
-    return None
+    return TREE.match(parent_abs, title, want_dir)
 
 
 def _partnership_dir_exists(name):
@@ -136,13 +1480,56 @@ def _partnership_dir_exists(name):
 
     Distinguishes a standing writing duo (their own series, their own folder)
     from a one-off collaboration filed under the lead author. Rooms are the
-    top level of DEST, so this is a couple of dozen cheap isdir() checks.
+    top level of DEST; each room is listed once per run by TREE, so after the
+    first book this is answered from memory. The one lookup that crosses rooms,
+    so a shard answers it from the shared index instead (see _partners).
     """
-    try:
-        rooms = os.listdir(DEST)
-    except OSError:
-        return False
-    return any(os.path.isdir(os.path.join(DEST, r, name)) for r in rooms)
+    if SHARD_COUNT > 1:
+        return name in _partners()
+    return any(TREE.isdir(os.path.join(DEST, r, name)) for r in TREE.subdirs(DEST))
+
+
+PARTNERS_FILE = os.path.splitext(STATE)[0] + ".partners.json"
+_PARTNERS = None
+
+
+def _scan_partners():
+    """{joined author folder: [rooms]} for every '<A> & <B>' folder in DEST."""
+    found = {}
+    for room in TREE.subdirs(DEST):
+        for name in TREE.subdirs(os.path.join(DEST, room)):
+            if " & " in name:
+                found.setdefault(name, []).append(room)
+    return found
+
+
+def _write_partners(found):
+    if DRY:
+        return
+    os.makedirs(os.path.dirname(PARTNERS_FILE) or ".", exist_ok=True)
+    with open(PARTNERS_FILE + f".{os.getpid()}.tmp", "w") as f:
+        json.dump(found, f, indent=1, ensure_ascii=False, sort_keys=True)
+    os.replace(f.name, PARTNERS_FILE)
+
+
+def _partners():
+    """The partnership index shards share, so no shard lists rooms it does not own.
+
+    Rebuilt by `reconcile.py shard-merge`. A run only ever files a book under
+    a joined folder that already exists, so the index cannot go stale during
+    a run; a pairing curated by hand shows up after the next merge. The first
+    shard to find no index builds it (the same scan every shard would make;
+    concurrent writers just replace one identical file with another).
+    """
+    global _PARTNERS
+    if _PARTNERS is None:
+        try:
+            with open(PARTNERS_FILE) as f:
+                _PARTNERS = json.load(f)
+        except FileNotFoundError:
+            _PARTNERS = _scan_partners()
+            _write_partners(_PARTNERS)
+    return _PARTNERS
 
 
 def _author_dir(genre_abs, authors):
@@ -160,7 +1547,7 @@ def _author_dir(genre_abs, authors):
     full = sanitize(authors or "")
     primary = sanitize((authors or "").split(" & ")[0])
     for cand in (full, primary):
-        if cand and os.path.isdir(os.path.join(genre_abs, cand)):
+        if cand and TREE.isdir(os.path.join(genre_abs, cand)):
             return cand
     # No folder yet, so the form has to be chosen. The two cases are genuinely
     # different and the tree already encodes which is which:
@@ -182,10 +1569,10 @@ def rel_path(b):
     when it genuinely has none. Generating a path unconditionally is what
     scattered 16 duplicate folders -- a book whose generated name disagreed with
     its real one was silently treated as new rather than as an error."""
-    genre = sanitize(b.get(GENRE_FIELD) or "")
-    author = _author_dir(os.path.join(DEST, genre), b.get("authors"))
-    title = sanitize(b.get("title") or "")
-    series = (b.get("series") or "").strip()
+    genre = sanitize(b.genre or "")
+    author = _author_dir(os.path.join(DEST, genre), b.authors)
+    title = sanitize(b.title or "")
+    series = (b.series or "").strip()
     if not (genre and author and title):
         return None
     parts = [genre, author] + ([sanitize(series)] if series else [])
@@ -197,13 +1584,6 @@ def rel_path(b):
     return os.path.join(*parts, folder, fname)
 
 
-def epub_of(b):
-    for p in (b.get("formats") or []):
-        if p.lower().endswith(".epub"):
-            return p
-    return None
-
-
 def _place(src, dst):
     """Copy Calibre's epub into the tree — never hardlink.
 
@@ -217,13 +1597,279 @@ def _place(src, dst):
     temp + os.replace, not a plain copy: the replace is atomic AND bumps the
     folder mtime, which bookorbit's incremental scanner prunes on — an in-place
     cp leaves the folder mtime untouched and the rescan reports "no changes".
+
+    The bytes themselves go through _copy, which keeps them on the NFS server
+    whenever the kernel lets it. Returns the strategy that moved them.
+
+    Without an fsync the rename can reach the disk before the bytes do, so a
+    node crash can leave a truncated epub under its final name. DURABILITY
+    decides what to pay for that: nothing, an fsync per file and folder, or
+    the same guarantee batched by RenameBatch, where dst appears only once the
+    batch commits.
     """
     tmp = dst + ".reconcile.tmp"
-    shutil.copy2(src, tmp)
+    try:
+        strategy = _copy(src, tmp)
+        shutil.copystat(src, tmp)     # copy2's mtime: _same_content's cheap path relies on it
+        if DURABILITY == "file":
+            _fsync(tmp)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    if DURABILITY == "batch":
+        RENAMES.add(tmp, dst)
+        return strategy
     os.replace(tmp, dst)
+    if DURABILITY == "file":
+        _fsync(os.path.dirname(dst))   # the rename itself
+    return strategy
+
+
+def _fsync(p):
+    """fsync a file or folder by path."""
+    fd = os.open(p, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        count("fsync")
+    finally:
+        os.close(fd)
+
+
+def _syncfs(p):
+    """syncfs(2) on the filesystem holding p: one call flushes every dirty file
+    on it. False where libc has no syncfs."""
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            if libc.syncfs(fd) != 0:
+                return False
+        finally:
+            os.close(fd)
+    except (OSError, AttributeError):
+        return False
+    count("syncfs")
+    return True
+
+
+class RenameBatch:
+    """DURABILITY=batch: temp files wait here and go durable in groups.
+
+    An fsync per file is a COMMIT round trip per epub on NFS, which is what
+    made per-file durability too slow for bulk copies. Here a group of
+    DURABILITY_BATCH finished temp files is flushed at once, by a single
+    syncfs where libc has it and otherwise by an fsync each. Only then is each
+    one renamed into place. The renames are made durable by a second syncfs,
+    or otherwise by one fsync per folder. A crash before the commit leaves
+    only *.reconcile.tmp files, never a torn epub under a real name. The next
+    run copies those books again, since their dst does not exist and their
+    state record is written only after the commit. run_pass commits a partial
+    batch before each checkpoint and after the pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def add(self, tmp, dst):
+        with self._lock:
+            self._pending.append((tmp, dst))
+            if len(self._pending) < DURABILITY_BATCH:
+                return
+            batch, self._pending = self._pending, []
+        self._commit(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self._commit(batch)
+
+    @staticmethod
+    def _commit(batch):
+        with phase("sync"):
+            fs = os.path.dirname(batch[0][0])
+            whole_fs = _syncfs(fs)
+            if not whole_fs:
+                for tmp, _ in batch:
+                    _fsync(tmp)
+            for tmp, dst in batch:
+                os.replace(tmp, dst)
+            if whole_fs:
+                _syncfs(fs)        # every rename at once; most books have a folder each
+            else:
+                for d in sorted({os.path.dirname(dst) for _, dst in batch}):
+                    _fsync(d)
+
+
+RENAMES = RenameBatch()
+
+
+class Throttle:
+    """Token buckets for the bytes and operations reconcile puts on the export.
+
+    citadel's NFS export also serves Plex streams and qBittorrent seeding, and
+    a bulk re-copy after a metadata change took all of it. Every copy chunk
+    and hash block takes its bytes from one bucket (MAX_MBPS) and one
+    operation from the other (MAX_IOPS) before it is issued. Each bucket holds
+    at most one second's budget. Taking more than is left puts the bucket in
+    debt, and the taker sleeps until the refill pays it off. That holds the
+    average rate across worker threads without a scheduler. Outside
+    THROTTLE_HOURS nothing is taken. Time spent waiting is reported as the
+    "throttled" phase (cumulative across workers, like compare and copy).
+    """
+
+    def __init__(self, mbps, iops, hours):
+        self.rates = {"bytes": mbps * 1e6, "ops": iops}
+        self.windows = []
+        for w in filter(None, (w.strip() for w in hours.split(","))):
+            start, end = (int(h) * 60 + int(m) for h, m in
+                          (t.split(":") for t in w.split("-")))
+            self.windows.append((start, end))
+        self._lock = threading.Lock()
+        self._level = {k: r for k, r in self.rates.items()}    # start full
+        self._at = dict.fromkeys(self.rates, time.monotonic())
+
+    def active(self):
+        if not any(self.rates.values()):
+            return False
+        if not self.windows:
+            return True
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        return any(s <= minute < e if s <= e else (minute >= s or minute < e)
+                   for s, e in self.windows)
+
+    def take(self, nbytes=0, ops=1):
+        if not self.active():
+            return
+        wait = 0.0
+        with self._lock:
+            now = time.monotonic()
+            for key, n in (("bytes", nbytes), ("ops", ops)):
+                rate = self.rates[key]
+                if not rate or not n:
+                    continue
+                level = min(rate, self._level[key] + (now - self._at[key]) * rate) - n
+                self._level[key], self._at[key] = level, now
+                wait = max(wait, -level / rate)
+        if wait > 0:
+            with phase("throttled"):
+                time.sleep(wait)
+
+
+THROTTLE = Throttle(MAX_MBPS, MAX_IOPS, THROTTLE_HOURS)
+
+# Chunk for the kernel-side copies, so the throttle sees a multi-GB file as
+# many takes instead of one.
+_COPY_CHUNK = 8 << 20
+
+FICLONE = 0x40049409    # linux/fs.h: _IOW(0x94, 9, int)
+
+# Errors that mean "this kernel/filesystem pair cannot do that", not "the copy
+# failed" -- the next strategy gets a go instead of the run aborting.
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP,
+                       errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.ETXTBSY}
+
+# Strategies that already failed as unsupported this run. LIB and DEST live on
+# one export, so one refusal holds for every later file too.
+_UNSUPPORTED = set()
+
+# strategy -> [files, bytes] moved this run, for the summary line.
+PLACED = {}
+_PLACED_LOCK = threading.Lock()
+
+
+def _copy_file_range(fi, fo, size):
+    """Server-side copy: NFS 4.2 turns this into a COPY the client never sees."""
+    off = 0
+    while off < size:
+        want = min(size - off, _COPY_CHUNK)
+        THROTTLE.take(want)
+        n = os.copy_file_range(fi, fo, want, off, off)
+        if n == 0:
+            break
+        off += n
+    return off
+
+
+def _ficlone(fi, fo, size):
+    """Reflink: share extents on a CoW filesystem. Copy-on-write, so unlike a
+    hardlink a later in-place rewrite of either side never reaches the other."""
+    THROTTLE.take()          # shares extents: metadata only, no bytes move
+    fcntl.ioctl(fo, FICLONE, fi)
+    return size
+
+
+def _sendfile(fi, fo, size):
+    """In-kernel copy: no round trip through this process's memory."""
+    off = 0
+    while off < size:
+        want = min(size - off, _COPY_CHUNK)
+        THROTTLE.take(want)
+        n = os.sendfile(fo, fi, off, want)
+        if n == 0:
+            break
+        off += n
+    return off
+
+
+def _userspace(fi, fo, size, chunk=1 << 20):
+    off = 0
+    while True:
+        blk = os.pread(fi, chunk, off)
+        THROTTLE.take(2 * len(blk), ops=2)    # the read and the write both cross the wire
+        if not blk:
+            return off
+        off += os.pwrite(fo, blk, off)
+
 
+_STRATEGIES = [
+    ("copy_file_range", _copy_file_range if hasattr(os, "copy_file_range") else None),
+    ("reflink", _ficlone),
+    ("sendfile", _sendfile if hasattr(os, "sendfile") else None),
+    ("userspace", _userspace),
+]
 
-def _same_content(src, dst):
+
+def _copy(src, tmp):
+    """Copy src to tmp with the cheapest mechanism this mount supports.
+
+    shutil.copy2 pulls every byte over NFS into the pod and pushes it back to
+    the same server. In order of preference: copy_file_range (server-side COPY
+    on NFS 4.2), FICLONE reflink, sendfile, and only then a plain read/write
+    loop. A strategy that refuses (see _UNSUPPORTED_ERRNOS) is skipped for the
+    rest of the run; a partial attempt is truncated away before the next.
+    """
+    with open(src, "rb") as fi, open(tmp, "wb") as fo:
+        size = os.fstat(fi.fileno()).st_size
+        for name, fn in _STRATEGIES:
+            if fn is None or name in _UNSUPPORTED:
+                continue
+            try:
+                moved = fn(fi.fileno(), fo.fileno(), size)
+            except OSError as e:
+                if name == "userspace" or e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                _UNSUPPORTED.add(name)
+                os.ftruncate(fo.fileno(), 0)
+                continue
+            if moved != size and name != "userspace":
+                # short copy (file changed under us?) -- retry plainly
+                os.ftruncate(fo.fileno(), 0)
+                continue
+            with _PLACED_LOCK:
+                rec = PLACED.setdefault(name, [0, 0])
+                rec[0] += 1
+                rec[1] += moved
+            return name
+
+
+def _same_content(src, dst, state):
     """Inode equality no longer means anything now that we copy, so compare the
     bytes' fingerprint instead: size first (cheap), then mtime, and only if those
     disagree, the bytes themselves.
@@ -233,93 +1879,1022 @@ def _same_content(src, dst):
     present the bytes come out identical but the mtime moves. Trusting mtime alone
     re-copied 37 byte-identical files after one night, which at full library size
     means copying the whole tree nightly and bumping every folder's mtime, which in
-    turn makes ABS re-index books that never changed."""
+    turn makes ABS re-index books that never changed.
+
+    Digests are remembered in `state` against the file's (size, mtime_ns, inode),
+    so each side is read at most once per change: after a bake the Calibre copy
+    is hashed on the next run only, and a steady-state run reads no bytes."""
     try:
-        a, b = os.stat(src), os.stat(dst)
+        a, b = _stat(src), _stat(dst)
     except OSError:
         return False
+    _note_links(a, dst, b)
     if a.st_size != b.st_size:
         return False
     if int(a.st_mtime) == int(b.st_mtime):
         return True
-    return _digest(src) == _digest(dst)
+    da, db = _fingerprint(src, a, state), _fingerprint(dst, b, state)
+    if _kind(da) != _kind(db):
+        # One side cached under COMPARE=md5, the other zipped now: equal bytes
+        # would never compare equal. Take both afresh, the same way.
+        da, db = _fingerprint(src, a, state, fresh=True), _fingerprint(dst, b, state, fresh=True)
+    return da == db
+
+
+def _note_links(a, dst, b):
+    """Tally dst's link count, and whether it is Calibre's very inode (`a`)."""
+    with _STATS_LOCK:
+        n = min(b.st_nlink, 3)
+        NLINK[n] = NLINK.get(n, 0) + 1
+        if (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino):
+            CALIBRE_SHARED[dst] = b.st_nlink
+
+
+def _fingerprint(p, st, state, fresh=False):
+    """_digest(p), unless `state` already holds it for this exact size/mtime/inode
+    (and `fresh` is not set)."""
+    key = [st.st_size, st.st_mtime_ns, st.st_ino]
+    rec = state.fingerprints.get(p)
+    if not fresh and rec and rec[:3] == key and rec[3].startswith(_DIGEST_KINDS[COMPARE]):
+        return rec[3]
+    digest = _digest(p)
+    state.set_fingerprint(p, key + [digest])
+    return digest
+
+
+# Digests are tagged with how they were taken; a cached one only counts when
+# the current COMPARE mode could have produced it.
+# Only digests of one kind compare: see _same_content.
+_DIGEST_KINDS = {"zip": ("zip:", "md5:"), "md5": ("md5:",)}
+
 
+def _kind(digest):
+    return digest.split(":", 1)[0]
 
-def _digest(p, chunk=1 << 20):
+
+def _digest(p):
+    THROTTLE.take()
+    if COMPARE == "zip":
+        try:
+            return _zip_digest(p)
+        except (zipfile.BadZipFile, ValueError, EOFError):
+            pass       # not an intact ZIP -- let the bytes speak
+    return _md5_digest(p)
+
+
+def _zip_digest(p):
+    """Fingerprint an epub from its ZIP central directory alone.
+
+    An epub is a ZIP, and the central directory at the end of the file already
+    records every member's name, CRC32 and size. Comparing those answers "same
+    book?" from a few KB at the tail instead of the whole multi-MB file -- the
+    difference that matters on an NFS export shared with Plex and qBittorrent.
+    Members are sorted so a rewrite that only reorders them still matches.
+    A truncated or corrupt file has no readable directory and falls back to
+    _md5_digest in _digest.
+    """
+    h = hashlib.md5()
+    with zipfile.ZipFile(p) as z:
+        for i in sorted(z.infolist(), key=lambda i: i.filename):
+            h.update(f"{i.filename}\0{i.CRC:08x}\0{i.file_size}\n".encode())
+        z.fp.seek(0, os.SEEK_END)
+        count("hash_bytes", z.fp.tell() - z.start_dir)   # the directory + end record we read
+        THROTTLE.take(z.fp.tell() - z.start_dir, ops=0)  # already read: settle up after
+    count("hashes")
+    return "zip:" + h.hexdigest()
+
+
+def _md5_digest(p, chunk=1 << 20):
     h = hashlib.md5()
     with open(p, 'rb') as f:
         for blk in iter(lambda: f.read(chunk), b''):
+            THROTTLE.take(len(blk))    # after the read: a short file is charged what it was
             h.update(blk)
-    return h.hexdigest()
+            count("hash_bytes", len(blk))
+    count("hashes")
+    return "md5:" + h.hexdigest()
 
 
-def main():
-    books = json.loads(calibredb(
-        "list", "--search", f'tag:"{TAG}"', "--fields", FIELDS, "--for-machine") or "[]")
-    state = load_state()
-    linked = relinked = moved = skipped = ok = conflicts = 0
+def _near_miss(rp):
+    """(new folder, existing folder, score) if the first folder `rp` would
+    create below the author's looks like a sibling already there, else None."""
+    if not FUZZY_THRESHOLD:
+        return None
+    parts = rp.split(os.sep)[:-1]
+    for depth in range(2, len(parts)):
+        parent = os.path.join(DEST, *parts[:depth])
+        if not TREE.isdir(os.path.join(parent, parts[depth])):
+            hit = TREE.near(parent, parts[depth])
+            return (parts[depth], *hit) if hit else None
+    return None
+
+
+def _locality(b):
+    """Sort key putting books in destination-folder order: genre, author,
+    series, title, then id.
 
+    Which of two books aiming at one path is placed and which reports the
+    CONFLICT is decided by which plan() reaches first; in Calibre's id order
+    that was the lower id. series_index is left out of the key and ties go
+    to the id, so a contest between copies of one title still goes the same
+    way. Books whose genre, author or series strings differ but resolve to
+    one folder anyway (match() is looser than this key) are ordered by those
+    strings, so among them it is no longer necessarily the lowest id.
+    """
+    return (str(b.genre or "").lower(), (b.authors or "").lower(), (b.series or "").lower(),
+            (b.title or "").lower(), int(b.id) if b.id.isdigit() else 0, b.id)
+
+
+def _nfs_ops(path, stats="/proc/self/mountstats"):
+    """{RPC: count} of the NFS mount holding `path`, or None off NFS.
+
+    The client's attribute and dentry caches are what locality is for, and
+    they are invisible from here except through the RPCs they fail to save:
+    a LOOKUP, GETATTR or READDIR on the wire is a miss.
+    """
+    path, best, ops = os.path.realpath(path), None, None
+    try:
+        with open(stats) as f:
+            inside = False        # in the block of the best mount so far
+            for line in f:
+                if line.startswith("device "):
+                    mnt, _, rest = line.partition(" mounted on ")[2].partition(" with fstype ")
+                    inside = (rest.startswith("nfs")
+                              and (path == mnt or path.startswith(mnt.rstrip("/") + "/"))
+                              and (best is None or len(mnt) > len(best)))
+                    if inside:
+                        best, ops = mnt, {}
+                elif inside and line.strip().split(":")[0] in _NFS_MISSES:
+                    name, counts = line.strip().split(":", 1)
+                    ops[name] = int(counts.split()[0])
+    except (OSError, ValueError):
+        return None
+    return ops
+
+
+_NFS_MISSES = ("LOOKUP", "GETATTR", "READDIR", "READDIRPLUS")
+
+
+def _cache_report(ops, nfs0):
+    """The run summary's locality line, and its numbers for the metrics.
+
+    - folder: share of ops landing in the previous op's author folder, the
+      locality the ordering buys (id order scatters it across rooms);
+    - tree: share of TREE lookups answered without a scandir;
+    - nfs: share of this run's stat/scandir calls that needed no
+      LOOKUP/GETATTR/READDIR RPC, where DEST is on NFS.
+    """
+    rates, prev, near, n = {}, None, 0, 0
+    for op in ops:
+        if op["action"] != "skip":
+            folder = op["rp"].split(os.sep)[:2]
+            near += folder == prev
+            n += 1
+            prev = folder
+    if n:
+        rates["folder"] = near / n
+    hits = STATS.get("tree_hits", 0) + STATS.get("probes_saved", 0)
+    calls = STATS.get("stat", 0) + STATS.get("scandir", 0)
+    if hits + STATS.get("scandir", 0):
+        rates["tree"] = hits / (hits + STATS.get("scandir", 0))
+    nfs1 = _nfs_ops(DEST) if nfs0 is not None else None
+    rpcs = sum(nfs1.get(k, 0) - nfs0.get(k, 0) for k in _NFS_MISSES) if nfs1 else None
+    if rpcs is not None and calls:
+        rates["nfs"] = max(0.0, 1 - rpcs / calls)
+    line = "locality: " + ", ".join(f"{k}={v:.1%}" for k, v in rates.items())
+    if rpcs is not None:
+        line += f" | nfs {rpcs:,} lookup/getattr/readdir RPCs for {calls:,} stat/scandir"
+    return line, rates
+
+
+def plan(books, paths):
+    """Phase 1: decide what every book needs from TREE alone -- no bytes read.
+
+    Serial on purpose. Each decision is recorded in TREE as though it had
+    already been carried out, so a later book sees the folders an earlier one
+    will create or vacate, exactly as the old one-book-at-a-time loop did.
+    Whether an existing file is current is left to execution (it may hash).
+    """
+    ops = []
     for b in books:
-        bid, rp, src = str(b["id"]), rel_path(b), epub_of(b)
-        if not rp or not src or not os.path.exists(src):
-            print(f"SKIP id={bid} '{b.get('title')}' (missing genre/author/title/epub) -> review")
-            skipped += 1
+        bid, rp, src = b.id, rel_path(b), b.epub
+        if not rp or not src or not _exists(src):
+            ops.append({"bid": bid, "action": "skip", "title": b.title})
             continue
         dst = os.path.join(DEST, rp)
-        prev = state.get(bid)
+        prev = paths.get(bid)
+        op = {"bid": bid, "src": src, "dst": dst, "rp": rp, "prev": prev, "stale": None}
+        near = None if TREE.lexists(dst) else _near_miss(rp)
+        if near and FUZZY_ACTION == "hold":      # held as-is: nothing moved, nothing created
+            op.update(action="neardup", near=near)
+            ops.append(op)
+            continue
+        if prev and prev != dst and TREE.lexists(prev):          # metadata moved the path
+            op["stale"] = prev
+            TREE.drop_file(prev)
+        if TREE.lexists(dst):
+            op["action"] = "compare"
+        else:
+            op["action"] = "copy"
+            op["near"] = near
+            op["colocated"] = TREE.isdir(os.path.dirname(dst))
+            TREE.add_dirs(os.path.dirname(dst))
+            TREE.added(dst, False)
+        ops.append(op)
+    return ops
 
-        if prev and prev != dst and os.path.lexists(prev):       # metadata moved the path
-            if not DRY:
-                os.remove(prev)
-                try:
-                    os.removedirs(os.path.dirname(prev))
-                except OSError:
-                    pass
-            moved += 1
-            print(f"MOVED id={bid}: removed stale {prev}"
-                  f"{'  (DRY RUN - not removed)' if DRY else ''}")
-
-        if not os.path.lexists(dst):
-            colocated = os.path.isdir(os.path.dirname(dst))
-            tag = 'colocated' if colocated else 'NEW FOLDER'
-            print(f"COPY   id={bid} -> {rp}  [{tag}]")
-            if not DRY:
-                os.makedirs(os.path.dirname(dst), exist_ok=True)
-                _place(src, dst)
-            linked += 1
-        elif not _same_content(src, dst):
-            dsz, ssz = os.stat(dst).st_size, os.stat(src).st_size
-            # Two very different situations, previously indistinguishable because
-            # generated paths never landed on a curated file:
-            #   prev == dst -> WE linked this before and Calibre's file changed
-            #                  (re-convert / embed). Re-linking is correct.
-            #   otherwise   -> a file WE NEVER PLACED already occupies this path.
-            #                  It is the curated tree copy, and which edition is
-            #                  better is a human judgement, not a cronjob's.
-            if prev == dst or ALLOW_REPLACE:
-                print(f"RELINK id={bid} (file changed) -> {rp}  "
-                      f"tree={dsz:,}B calibre={ssz:,}B"
-                      f"{'  (DRY RUN - not written)' if DRY else ''}")
+
+def _remove_stale(p):
+    """os.remove, then prune the emptied folders upward like os.removedirs."""
+    os.remove(p)
+    d = os.path.dirname(os.path.normpath(p))
+    while os.path.dirname(d) != d:
+        try:
+            os.rmdir(d)
+        except OSError:
+            break
+        d = os.path.dirname(d)
+
+
+def _size(p):
+    try:
+        return _stat(p).st_size
+    except OSError:
+        return 0          # DRY RUN: an earlier book's copy was only planned
+
+
+def decide(op, state):
+    """Phase 2a for one book: settle what it needs. Returns (log lines, outcome);
+    writes nothing -- execute() does that, and `reconcile.py plan` stops here."""
+    bid, src, dst, rp = op["bid"], op["src"], op["dst"], op["rp"]
+    if op["action"] == "neardup":
+        new, existing, score = op["near"]
+        return [f"NEARDUP id={bid} -> {rp}  new folder '{new}' looks like existing "
+                f"'{existing}' ({score:.2f}); not created -- rename one to match "
+                f"(FUZZY_ACTION=warn creates it anyway)"], "neardup"
+    if op["action"] == "copy":
+        tag = 'colocated' if op["colocated"] else 'NEW FOLDER'
+        lines = [f"COPY   id={bid} -> {rp}  [{tag}]"]
+        if op.get("near"):
+            new, existing, score = op["near"]
+            lines.append(f"WARN   id={bid}: new folder '{new}' looks like existing "
+                         f"'{existing}' ({score:.2f})")
+        return lines, "linked"
+    with phase("compare"):
+        same = _same_content(src, dst, state)
+    if dst in CALIBRE_SHARED:
+        # Same inode means same bytes, so this is always "current" -- and the
+        # copy-not-link invariant is broken: the nightly bake writes through it.
+        return [f"OK     id={bid} (current)",
+                f"WARN   id={bid}: {rp} IS Calibre's file (shared inode, "
+                f"nlink={CALIBRE_SHARED[dst]}) -- embed_metadata writes into the tree; "
+                f"break the link (cp, then mv over it)"], "ok"
+    if same:
+        return [f"OK     id={bid} (current)"], "ok"
+    dsz, ssz = _size(dst), _stat(src).st_size
+    # Two very different situations, previously indistinguishable because
+    # generated paths never landed on a curated file:
+    #   prev == dst -> WE linked this before and Calibre's file changed
+    #                  (re-convert / embed). Re-linking is correct.
+    #   otherwise   -> a file WE NEVER PLACED already occupies this path.
+    #                  It is the curated tree copy, and which edition is
+    #                  better is a human judgement, not a cronjob's.
+    if op["prev"] == dst or ALLOW_REPLACE:
+        return [f"RELINK id={bid} (file changed) -> {rp}  "
+                f"tree={dsz:,}B calibre={ssz:,}B"
+                f"{'  (DRY RUN - not written)' if DRY else ''}"], "relinked"
+    return [f"CONFLICT id={bid} -> {rp}  tree={dsz:,}B calibre={ssz:,}B"
+            f"  — pre-existing file not placed by us; left untouched "
+            f"(set ALLOW_REPLACE=1 to overwrite)"], "conflicts"
+
+
+def execute(op, state):
+    """Phase 2 for one book: decide, then copy if needed. Returns (log lines, outcome).
+
+    An op from a plan file arrives already decided; it is only re-checked
+    against the preconditions the plan observed (see _verify)."""
+    if "outcome" in op:
+        why = _verify(op, state)
+        if why:
+            return [f"REJECT id={op['bid']} -> {op['rp']}  {why} since the plan; "
+                    f"not applied (re-plan)"], "rejected"
+        lines, outcome = op["lines"], op["outcome"]
+    else:
+        lines, outcome = decide(op, state)
+    if outcome in ("linked", "relinked") and not DRY:
+        with phase("copy"):
+            os.makedirs(os.path.dirname(op["dst"]), exist_ok=True)
+            _place(op["src"], op["dst"])      # copy, never hardlink
+    return lines, outcome
+
+
+PLAN_VERSION = 1
+# Which shard a plan was made for; SHARD_INDEX means nothing unsharded.
+PLAN_SHARD = {"shard_index": SHARD_INDEX if SHARD_COUNT > 1 else 0, "shard_count": SHARD_COUNT}
+
+
+def _observe(p, state):
+    """A plan precondition: [size, mtime_ns, digest or None], or None if `p` is
+    absent. The digest is whatever the fingerprint cache already holds for this
+    exact file -- observing never reads bytes."""
+    try:
+        st = _stat(p)
+    except OSError:
+        return None
+    rec = state.fingerprints.get(p)
+    digest = rec[3] if rec and rec[:3] == [st.st_size, st.st_mtime_ns, st.st_ino] else None
+    return [st.st_size, st.st_mtime_ns, digest]
+
+
+def _changed(p, pre, state):
+    """How `p` differs from the precondition _observe recorded, or None.
+
+    Same size and mtime is unchanged. A moved mtime with a recorded digest is
+    fingerprinted again, so the nightly bake touching a file between plan and
+    apply does not reject it."""
+    try:
+        st = _stat(p)
+    except OSError:
+        return None if pre is None else "is gone"
+    if pre is None:
+        return "appeared"
+    size, mtime_ns, digest = pre
+    if st.st_size != size:
+        return "changed size"
+    if st.st_mtime_ns == mtime_ns:
+        return None
+    if digest:
+        now = _fingerprint(p, st, state)
+        if _kind(now) != _kind(digest):
+            now = _fingerprint(p, st, state, fresh=True)
+        if now == digest:
+            return None
+    return "was modified"
+
+
+def _verify(op, state):
+    """Why a planned op may no longer be carried out, or None."""
+    if op.get("reject"):
+        return op["reject"]
+    if op["outcome"] not in ("linked", "relinked"):
+        return None           # nothing to write, nothing to protect
+    for side in ("src", "dst"):
+        why = _changed(op[side], op["pre"][side], state)
+        if why:
+            return f"{side} {why}"
+    return None
+
+
+def _resume_point(state, work):
+    """(work list digest, books already done) for this pass.
+
+    A checkpoint counts only for the exact work list it was written against:
+    the same scope and the same books with the same last_modified, in the same
+    order. The watermark does not move until a run completes, so a restarted
+    run asks the same query and gets the same list back. It then skips the
+    books before the checkpoint; their results are already in the journal. If
+    Calibre changed anything in between, or a sweep fell due, the digest
+    differs and the run starts from the first book.
+    """
+    key = hashlib.sha1(json.dumps(work).encode()).hexdigest()
+    cp = state.meta.get("checkpoint")
+    if cp and cp["work"] == key:
+        print(f"resume: {cp['done']} book(s) done before the last checkpoint "
+              f"(id={cp['last']}), continuing from there")
+        return key, cp["done"]
+    return key, 0
+
+
+def _scope(meta, started):
+    """(full sweep?, `since` date for fetch_books or None)."""
+    wm = meta.get("watermark")
+    full = FORCE_FULL or not wm or started - meta.get("last_full", 0) >= FULL_EVERY
+    since = None if full else (
+        datetime.fromisoformat(wm) - timedelta(days=1)).strftime("%Y-%m-%d")
+    return full, since
+
+
+def _by_folder(ops):
+    """Ops grouped by destination folder, book order kept within each group."""
+    groups = {}
+    for op in ops:
+        if op["action"] != "skip":
+            groups.setdefault(os.path.dirname(op["dst"]), []).append(op)
+    return list(groups.values())
+
+
+def make_plan(state):
+    """`reconcile.py plan`: everything a run would do, decided but not done.
+
+    DRY_RUN=1 printed this for a human and the real run then worked it all out
+    again -- twice the NFS traffic for a bulk session, and no guarantee the run
+    did what was reviewed. The plan records each book's decided outcome plus
+    what it observed of src, dst and any stale file (size, mtime, digest), so
+    `reconcile.py apply` can carry it out without resolving a single path, and
+    refuse any operation whose files have moved on since (see _verify).
+
+    Like run_pass, a shard plans only the books it owns, and the plan names
+    its shard: applied by another shard it would write into that shard's
+    rooms and record their books in the wrong overlay.
+    """
+    started = time.time()
+    full, since = _scope(state.meta, started)
+    with phase("query"):
+        fetched = fetch_books(since)
+    books = sorted((b for b in fetched if state.owns(b)), key=_locality)
+    with phase("resolve"):
+        ops = plan(books, state.paths)
+    groups = _by_folder(ops)
+    with ThreadPoolExecutor(WORKERS) as pool:
+        results = pool.map(lambda g: [decide(op, state) for op in g], groups)
+        for group, decided in zip(groups, results):
+            for op, (lines, outcome) in zip(group, decided):
+                op.update(lines=lines, outcome=outcome, pre={
+                    "src": _observe(op["src"], state),
+                    "dst": _observe(op["dst"], state) if op["action"] == "compare" else None,
+                    "stale": _observe(op["stale"], state) if op["stale"] else None})
+    counts = {}
+    for op in ops:
+        if op["action"] == "skip":
+            print(f"SKIP id={op['bid']} '{op['title']}' (missing genre/author/title/epub) "
+                  f"-> review", file=sys.stderr)
+            continue
+        if op["stale"]:
+            print(f"MOVED id={op['bid']}: remove stale {op['stale']}", file=sys.stderr)
+        print("\n".join(op["lines"]), file=sys.stderr)
+        counts[op["outcome"]] = counts.get(op["outcome"], 0) + 1
+    scope = "full sweep" if full else "modified since " + since
+    print(f"\nplan: {len(books)} {TAG} book(s) [{scope}] | "
+          + " ".join(f"{k}={v}" for k, v in sorted(counts.items())), file=sys.stderr)
+    stamps = [b.last_modified for b in fetched if b.last_modified]
+    return {"version": PLAN_VERSION, "created": datetime.now().isoformat(timespec="seconds"),
+            "lib": LIB, "dest": DEST, "compare": COMPARE, **PLAN_SHARD,
+            "full": full, "since": since,
+            "newest": max(stamps, key=datetime.fromisoformat) if stamps else None,
+            "ops": ops}
+
+
+def apply_plan(path):
+    """`reconcile.py apply <plan>`: carry out a plan from make_plan as reviewed.
+    Exits 1 if any operation was rejected, 2 if the plan is for another tree
+    or shard."""
+    with open(path) as f:
+        planned = json.load(f)
+    want = {"version": PLAN_VERSION, "lib": LIB, "dest": DEST, "compare": COMPARE, **PLAN_SHARD}
+    wrong = [k for k, v in want.items() if planned.get(k) != v]
+    if wrong:
+        print(f"{path}: plan does not match this run ({', '.join(wrong)}); re-plan",
+              file=sys.stderr)
+        return 2
+    state = open_state(dry=DRY)
+    try:
+        with profiling() as label:
+            counts = label["books"] = run_pass(state, planned=planned)
+    finally:
+        state.close()
+    SCAN.flush(force=True)
+    return 1 if counts["rejected"] else 0
+
+
+def main():
+    state = open_state(dry=DRY)
+    try:
+        with profiling() as label:
+            label["books"] = run_pass(state)
+    finally:
+        state.close()
+    SCAN.flush(force=True)
+
+
+def run_pass(state, seen=None, planned=None):
+    """One reconcile pass: query, plan, execute, record, report. Returns the
+    outcome counts.
+
+    `seen` is the watch daemon's {book id: last_modified} from earlier passes;
+    between sweeps, a book whose last_modified has not moved since is dropped
+    before planning, so a pass costs only the books that actually changed.
+    `planned` is a plan file (see make_plan): no query and no planning, its
+    ops are executed as decided wherever their preconditions still hold.
+    """
+    for counters in (PHASES, STATS, PLACED, NLINK, CALIBRE_SHARED):
+        counters.clear()
+    started = time.time()
+    nfs0 = _nfs_ops(DEST)
+    wm = state.meta.get("watermark")
+    live = set()             # every src/dst this run looked at: the fingerprints worth keeping
+    counts = dict.fromkeys(("linked", "relinked", "moved", "ok", "skipped", "conflicts"), 0)
+    if planned is None:
+        full, since = _scope(state.meta, started)
+        if full:
+            TREE.reset()
+        with phase("query"):
+            books = fetch_books(since)
+        tagged = {b.id for b in books} if full else None
+        if seen is not None:
+            if not full:
+                books = [b for b in books if seen.get(b.id) != b.last_modified]
+            seen.update((b.id, b.last_modified) for b in books)
+        modified = [b.last_modified for b in books if b.last_modified]
+        books = sorted((b for b in books if state.owns(b)), key=_locality)
+        work = [full, since] + [(b.id, b.last_modified) for b in books]
+        key, resumed = _resume_point(state, work)
+        for b in books[:resumed]:          # finished before the crash: still live
+            live.update((b.epub, state.paths.get(b.id)))
+        books = books[resumed:]
+        with phase("resolve"):
+            ops = plan(books, state.paths)
+    else:
+        full, since, ops = planned["full"], planned["since"], planned["ops"]
+        tagged = None
+        modified = [planned["newest"]] if planned["newest"] else []
+        counts["rejected"] = 0
+        key, resumed = _resume_point(state, [planned["created"]] + [op["bid"] for op in ops])
+        ops = ops[resumed:]
+        # Checked here, serially, because they gate the stale removals below.
+        for op in ops:
+            if op["action"] == "skip":
+                continue
+            if state.paths.get(op["bid"]) != op["prev"]:
+                op["reject"] = "recorded state changed"
+            elif op["stale"]:
+                # The move's copy must be able to go ahead as well, or the
+                # old file would be gone and the new one rejected: check src
+                # and dst here too, not only once the pool gets to them.
+                why = _changed(op["stale"], op["pre"]["stale"], state)
+                op["reject"] = "stale file " + why if why else _verify(op, state)
+
+    # Stale removals first and serially: they prune emptied folders, and a prune
+    # racing a copy into a sibling folder could delete the parent mid-makedirs.
+    if not DRY:
+        with phase("remove"):
+            for op in ops:
+                if op.get("stale") and not op.get("reject"):
+                    _remove_stale(op["stale"])
+
+    # Then compare/copy on the pool, one task per destination folder so
+    # operations on the same folder keep their book order.
+    t_exec = time.perf_counter()
+    with ThreadPoolExecutor(WORKERS) as pool:
+        done = {}
+        for group in _by_folder(ops):
+            fut = pool.submit(lambda g: [execute(op, state) for op in g], group)
+            for i, op in enumerate(group):
+                done[id(op)] = (fut, i)
+
+        # Report and record in book order, whatever order the pool finished in.
+        # Under DURABILITY=batch a placed book's dst only exists once its batch
+        # commits, so its record waits in `deferred` until then: a synced
+        # record or checkpoint must never run ahead of the rename.
+        prev_bid, deferred = None, []
+
+        def commit_deferred():
+            RENAMES.flush()
+            for args in deferred:
+                state.set_path(*args)
+            deferred.clear()
+
+        for n, op in enumerate(ops, resumed + 1):
+            bid = op["bid"]
+            if CHECKPOINT_EVERY and n % CHECKPOINT_EVERY == 0 and not DRY:
+                # Everything before this book is recorded; the journal keeps
+                # order, so a durable checkpoint implies durable records.
+                commit_deferred()
+                state.set_meta("checkpoint", {"work": key, "done": n - 1, "last": prev_bid})
+                state.sync()
+            prev_bid = bid
+            if op["action"] == "skip":
+                print(f"SKIP id={bid} '{op['title']}' (missing genre/author/title/epub) -> review")
+                counts["skipped"] += 1
+                continue
+            if op["stale"] and not op.get("reject"):
+                counts["moved"] += 1
+                print(f"MOVED id={bid}: removed stale {op['stale']}"
+                      f"{'  (DRY RUN - not removed)' if DRY else ''}")
                 if not DRY:
-                    _place(src, dst)          # copy, never hardlink
-                relinked += 1
-            else:
-                print(f"CONFLICT id={bid} -> {rp}  tree={dsz:,}B calibre={ssz:,}B"
-                      f"  — pre-existing file not placed by us; left untouched "
-                      f"(set ALLOW_REPLACE=1 to overwrite)")
-                conflicts += 1
-                continue          # do NOT record state for a path we did not write
-        else:
-            ok += 1
-            print(f"OK     id={bid} (current)")
-        state[bid] = dst
+                    SCAN.touched(op["stale"], "unlink")
+            fut, i = done[id(op)]
+            lines, outcome = fut.result()[i]
+            print("\n".join(lines))
+            counts[outcome] = counts.get(outcome, 0) + 1
+            if outcome in ("linked", "relinked") and not DRY:
+                SCAN.touched(op["dst"], "add")
+            live.update((op["src"], op["dst"]))
+            # do NOT record a path we did not write
+            if outcome not in ("conflicts", "rejected", "neardup"):
+                if DURABILITY == "batch" and outcome in ("linked", "relinked") and not DRY:
+                    deferred.append((bid, op["dst"]))
+                else:
+                    state.set_path(bid, op["dst"])
+        commit_deferred()
+    PHASES["execute"] = time.perf_counter() - t_exec
 
+    # The watermark moves only once the whole run has landed: a crash must
+    # leave the next run asking for the same books again.
+    with phase("state"):
+        if full:        # only a sweep has seen every book, so only it may prune
+            state.prune_fingerprints(live)
+            state.set_meta("last_full", started)
+            if tagged is not None:      # for `state orphans`, without asking Calibre
+                state.set_meta("untagged", sorted(b for b in state.paths if b not in tagged))
+        stamps = ([wm] if wm else []) + modified
+        if stamps and not counts.get("rejected"):   # a rejected book must come round again
+            state.set_meta("watermark", max(stamps, key=datetime.fromisoformat))
+        state.set_meta("checkpoint", None)
+        state.sync()
+    scope = "full sweep" if full else f"modified since {since}"
+    if resumed:
+        scope += f", resumed after {resumed}"
+    print(f"\ndone{' (DRY RUN — nothing written)' if DRY else ''}: {len(ops)} {TAG} book(s) "
+          f"[{scope}] | "
+          + " ".join(f"{k}={v}" for k, v in counts.items()))
+    if PLACED:
+        print("placed via " + ", ".join(
+            f"{k}={n} file(s)/{b:,}B" for k, (n, b) in PLACED.items()))
+    if CALIBRE_SHARED or NLINK.get(3):
+        print(f"WARN links: {len(CALIBRE_SHARED)} tree file(s) share an inode with Calibre, "
+              f"{NLINK.get(3, 0)} at nlink>=3 (`reconcile.py links` maps them)")
+    line, rates = _cache_report(ops, nfs0)
+    print(line)
+    print("cost: " + " ".join(f"{k}={v:.2f}s" for k, v in PHASES.items())
+          + f" total={time.time() - started:.2f}s | "
+          + " ".join(f"{k}={v:,}" for k, v in sorted(STATS.items())))
     if not DRY:
-        save_state(state)
-    print(f"\ndone{' (DRY RUN — nothing written)' if DRY else ''}: {len(books)} {TAG} book(s) | "
-          f"linked={linked} relinked={relinked} moved={moved} ok={ok} "
-          f"skipped={skipped} conflicts={conflicts}")
+        write_metrics(counts, full, started, rates)
+    return counts
+
+
+class ScanNotifier:
+    """Tell AudiobookShelf exactly which library folders changed.
+
+    _place bumps folder mtimes so the incremental scanner notices, but ABS
+    still walks the whole library to find them. Instead, every folder this run
+    created, replaced into or removed from is queued here and handed to ABS's
+    watcher endpoint (POST /api/watcher/update, the same hook its own file
+    watcher uses) -- one request per folder, last event wins. Past SCAN_MAX
+    folders in one flush, a single library scan (POST /api/libraries/<id>/scan)
+    is cheaper than the storm. Under --watch, flushes wait until nothing new
+    has been queued for SCAN_DEBOUNCE seconds; a one-shot run flushes at exit.
+    A failed notification is reported, never fatal: the scheduled ABS scan
+    still finds the change, only later. The first failure ends the flush --
+    one SCAN_TIMEOUT, not one per folder, against a stalled ABS -- and puts
+    the folders not yet sent back in the queue for the next one.
+    """
+
+    def __init__(self):
+        self.pending = {}      # folder -> (type, path)
+        self.last_change = 0.0
+        self.sent = 0
+
+    def touched(self, path, kind):
+        if ABS_URL:
+            self.pending[os.path.dirname(path)] = (kind, path)
+            self.last_change = time.monotonic()
+
+    def flush(self, force=False):
+        if not self.pending or (
+                not force and time.monotonic() - self.last_change < SCAN_DEBOUNCE):
+            return
+        batch, self.pending = self.pending, {}
+        total = len(batch)
+        try:
+            if total > SCAN_MAX:
+                self._post(f"/api/libraries/{ABS_LIBRARY}/scan", {})
+                batch.clear()
+                print(f"scan: {total} folder(s) changed -> library scan")
+            else:
+                for folder, (kind, path) in list(batch.items()):
+                    self._post("/api/watcher/update",
+                               {"libraryId": ABS_LIBRARY, "path": self._abs_path(path),
+                                "type": kind})
+                    del batch[folder]
+                print(f"scan: notified ABS of {total} folder(s)")
+            self.sent += 1
+        except (OSError, http.client.HTTPException) as e:
+            # Newer events for a folder queued meanwhile win over the unsent one.
+            self.pending = {**batch, **self.pending}
+            print(f"WARN scan notification failed ({e}); {len(batch)} folder(s) left "
+                  f"queued, ABS's own scan will catch up")
+
+    @staticmethod
+    def _abs_path(path):
+        ours, _, theirs = ABS_PATH_MAP.partition("=")
+        if ours and (path == ours or path.startswith(ours.rstrip("/") + "/")):
+            return theirs.rstrip("/") + path[len(ours.rstrip("/")):]
+        return path
+
+    @staticmethod
+    def _post(route, body):
+        req = urllib.request.Request(
+            ABS_URL.rstrip("/") + route, data=json.dumps(body).encode(), method="POST",
+            headers={"Content-Type": "application/json",
+                     "Authorization": f"Bearer {ABS_TOKEN}"})
+        urllib.request.urlopen(req, timeout=SCAN_TIMEOUT).close()
+
+
+SCAN = ScanNotifier()
+
+
+def _inotify(path):
+    """An inotify fd watching `path` for writes, or None where that is unavailable.
+
+    On NFS inotify only sees changes made by THIS client, and Calibre writes
+    from another pod -- so watch() always polls as well; inotify just makes a
+    local write show up immediately instead of at the next poll.
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, path.encode(), 0x002 | 0x008 | 0x080 | 0x100) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def _db_signature():
+    """(mtime_ns, size) of metadata.db: every Calibre commit moves at least one."""
+    try:
+        st = os.stat(os.path.join(LIB, "metadata.db"))
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def watch():
+    """Long-running mode: reconcile within seconds of a Calibre change.
+
+    The CronJob pays for pod scheduling, a Python start, a calibredb start and
+    a library pass every tick, and a newly tagged book can still wait 15
+    minutes. Here the tree index and state stay warm in memory, metadata.db is
+    watched (inotify where it works, a stat poll every WATCH_POLL seconds
+    regardless), and a change -- once the db has been quiet for
+    WATCH_DEBOUNCE seconds, so a bulk edit is one pass not fifty -- runs an
+    incremental pass over just the books whose last_modified moved. Full
+    sweeps still happen every FULL_EVERY seconds and re-list the tree.
+    """
+    state = open_state(dry=DRY)
+    seen = {}
+    fd = _inotify(LIB)
+    # A pod shutdown is SIGTERM: leave through `finally` so the state is synced.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    last = None
+    print(f"watch: {os.path.join(LIB, 'metadata.db')} "
+          f"({'inotify + ' if fd is not None else ''}poll every {WATCH_POLL:g}s)")
+    try:
+        while True:
+            sig = _db_signature()
+            due = time.time() - state.meta.get("last_full", 0) >= FULL_EVERY
+            if sig != last or due:
+                if last is not None and sig != last:
+                    while True:          # debounce: wait for Calibre to go quiet
+                        time.sleep(WATCH_DEBOUNCE)
+                        settled = _db_signature()
+                        if settled == sig:
+                            break
+                        sig = settled
+                with profiling() as label:
+                    label["books"] = run_pass(state, seen)
+                sys.stdout.flush()
+                last = sig
+            SCAN.flush()
+            if fd is None:
+                time.sleep(WATCH_POLL)
+                continue
+            if select.select([fd], [], [], WATCH_POLL)[0]:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if fd is not None:
+            os.close(fd)
+        state.close()
+        SCAN.flush(force=True)
+
+
+def write_metrics(counts, full, started, cache=None):
+    """This run's cost in Prometheus text format, for Grafana to graph over time.
+
+    Every series is a gauge describing the LAST run -- a CronJob pod lives for
+    seconds, so there is no process to hold counters. Written atomically to
+    METRICS_FILE (a textfile collector, or anything that reads the state
+    volume) and/or PUT to PUSHGATEWAY under job="ebook-reconcile". A metrics
+    failure is reported but never fails the run.
+    """
+    def gauge(name, help_, samples):
+        out = [f"# HELP reconcile_{name} {help_}", f"# TYPE reconcile_{name} gauge"]
+        out += [f"reconcile_{name}{labels} {value}" for labels, value in samples]
+        return out
+
+    lines = gauge("phase_seconds",
+                  "Seconds per reconcile phase (compare/copy: summed worker time).",
+                  [(f'{{phase="{k}"}}', round(v, 6)) for k, v in PHASES.items()])
+    lines += gauge("books", "Books per outcome in the last run.",
+                   [(f'{{outcome="{k}"}}', v) for k, v in counts.items()])
+    lines += gauge("io_operations", "Filesystem operations in the last run.",
+                   [(f'{{op="{k}"}}', STATS.get(k, 0)) for k in ("scandir", "stat", "hashes")])
+    lines += gauge("io_bytes", "Bytes hashed and copied in the last run.",
+                   [('{kind="hash"}', STATS.get("hash_bytes", 0)),
+                    ('{kind="copy"}', sum(b for _, b in PLACED.values()))])
+    lines += gauge("copy_bytes", "Bytes copied per placement strategy in the last run.",
+                   [(f'{{strategy="{k}"}}', b) for k, (_, b) in PLACED.items()])
+    lines += gauge("tree_files_by_nlink", "Compared tree files per link count (3 = 3 or more).",
+                   [(f'{{nlink="{k}"}}', v) for k, v in sorted(NLINK.items())])
+    lines += gauge("calibre_shared_inodes", "Tree files that are hardlinks of Calibre's file.",
+                   [("", len(CALIBRE_SHARED))])
+    lines += gauge("cache_hit_ratio", "Locality of the last run (see _cache_report).",
+                   [(f'{{cache="{k}"}}', round(v, 4)) for k, v in (cache or {}).items()])
+    lines += gauge("run_duration_seconds", "Wall time of the last run.",
+                   [("", round(time.time() - started, 6))])
+    lines += gauge("full_sweep", "1 if the last run was a full sweep.", [("", int(full))])
+    lines += gauge("last_run_timestamp_seconds", "When the last run started.",
+                   [("", int(started))])
+    text = "\n".join(lines) + "\n"
+    path, group = METRICS_FILE, "/metrics/job/ebook-reconcile"
+    if SHARD_COUNT > 1 and path:     # one series per shard, not N pods overwriting one
+        path = f"{os.path.splitext(path)[0]}.shard{SHARD_INDEX}.prom"
+    if SHARD_COUNT > 1:
+        group += f"/shard/{SHARD_INDEX}"
+    try:
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+        if PUSHGATEWAY:
+            req = urllib.request.Request(
+                PUSHGATEWAY.rstrip("/") + group,
+                data=text.encode(), method="PUT",
+                headers={"Content-Type": "text/plain; version=0.0.4"})
+            urllib.request.urlopen(req, timeout=10).close()
+    except OSError as e:
+        print(f"WARN metrics not written: {e}")
+
+
+@contextmanager
+def profiling():
+    """Profile the enclosed pass into PROFILE_DIR when PROFILE asks for it.
+
+    A CronJob pod lives for seconds, so there is nothing to attach a profiler
+    to; the run has to profile itself. PROFILE=cpu writes a pstats file,
+    mem a tracemalloc snapshot, both both. Files are named
+    <start time>-<books>books (+ -shard<i>), so a slow run and a normal one
+    are easy to pick out and compare with `reconcile.py profile-diff`.
+
+    Up to Python 3.11 cProfile only sees the thread that enables it, and the
+    compare and copy work runs on the pool: every thread started inside the
+    block gets its own profiler through threading.setprofile, and they are
+    merged into one file at the end. From 3.12 cProfile is built on
+    sys.monitoring, which is interpreter-wide: one profiler sees every thread,
+    and a second one per thread would fail to enable. The caller stores
+    run_pass's counts as label["books"].
+    """
+    label = {}
+    if not PROFILE:
+        yield label
+        return
+    cpu = PROFILE in ("cpu", "both")
+    profiles = []
+    if cpu:
+        main_prof = cProfile.Profile()
+        if sys.version_info < (3, 12):
+            def per_thread(*_):
+                prof = cProfile.Profile()
+                try:
+                    prof.enable()         # replaces this hook for the thread
+                except ValueError:        # another profiler owns it: run unprofiled,
+                    sys.setprofile(None)  # never let a hook kill a pool worker
+                    return
+                profiles.append(prof)
+            threading.setprofile(per_thread)
+        main_prof.enable()
+    if PROFILE in ("mem", "both"):
+        tracemalloc.start(10)
+    started = datetime.now()
+    try:
+        yield label
+    finally:
+        snapshot = peak = None
+        if tracemalloc.is_tracing():      # what is still held at the end, and the high point
+            snapshot, peak = tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stats = None
+        if cpu:
+            main_prof.disable()
+            threading.setprofile(None)
+            stats = pstats.Stats(main_prof)
+            for prof in profiles:
+                prof.disable()
+                stats.add(prof)
+        counts = label.get("books") or {}
+        books = sum(v for k, v in counts.items() if k != "moved")
+        stem = os.path.join(PROFILE_DIR, f"{started:%Y%m%dT%H%M%S}-{books}books"
+                            + (f"-shard{SHARD_INDEX}" if SHARD_COUNT > 1 else ""))
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            written = []
+            if stats is not None:
+                stats.dump_stats(stem + ".pstats")
+                written.append(stem + ".pstats")
+            if snapshot is not None:
+                snapshot.dump(stem + ".tracemalloc")
+                written.append(stem + ".tracemalloc")
+            print("profile: " + " ".join(written)
+                  + (f" (traced peak {peak / 1024:,.0f}KiB)" if peak is not None else ""))
+        except OSError as e:
+            print(f"WARN profile not written: {e}")
+
+
+def profile_diff(a, b, top=25):
+    """`reconcile.py profile-diff A B`: what changed between two profiles.
+
+    Two .pstats files: functions ranked by how much their cumulative time
+    moved. Two .tracemalloc snapshots: source lines ranked by how much their
+    allocated memory moved. Pass the normal run as A and the slow one as B.
+    """
+    if a.endswith(".tracemalloc") and b.endswith(".tracemalloc"):
+        old, new = tracemalloc.Snapshot.load(a), tracemalloc.Snapshot.load(b)
+        for d in new.compare_to(old, "lineno")[:top]:
+            frame = d.traceback[0]
+            print(f"mem {d.size_diff / 1024:+12,.1f}KiB  {d.size / 1024:12,.1f}KiB now  "
+                  f"{d.count_diff:+8,} blocks  {frame.filename}:{frame.lineno}")
+        return 0
+    if a.endswith(".pstats") and b.endswith(".pstats"):
+        old, new = pstats.Stats(a).stats, pstats.Stats(b).stats
+        rows = []
+        for fn in old.keys() | new.keys():
+            _, n0, _, c0, _ = old.get(fn, (0, 0, 0, 0.0, None))
+            _, n1, _, c1, _ = new.get(fn, (0, 0, 0, 0.0, None))
+            rows.append((c1 - c0, c0, c1, n0, n1, fn))
+        rows.sort(key=lambda r: -abs(r[0]))
+        for delta, c0, c1, n0, n1, (path, line, name) in rows[:top]:
+            print(f"cpu {delta:+9.3f}s cum  ({c0:.3f}s -> {c1:.3f}s)  "
+                  f"{n0:,} -> {n1:,} calls  {os.path.basename(path)}:{line}({name})")
+        return 0
+    print("profile-diff: give two .pstats or two .tracemalloc files", file=sys.stderr)
+    return 2
 
 
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser(description="Reconcile →abs books into the ABS tree.")
+    ap.add_argument("--watch", action="store_true",
+                    help="stay running and reconcile as metadata.db changes")
+    sub = ap.add_subparsers(dest="cmd")
+    sub.add_parser("verify-backend", help="diff BACKEND=sqlite against calibredb")
+    st = sub.add_parser("state", help="query the recorded book -> path state")
+    st_sub = st.add_subparsers(dest="what", required=True)
+    st_sub.add_parser("owners", help="books recorded at or under a path").add_argument("path")
+    st_sub.add_parser("collisions", help="paths recorded against more than one book")
+    st_sub.add_parser("orphans", help="recorded books no longer tagged").add_argument(
+        "--missing", action="store_true", help="also report recorded paths gone from disk")
+    sub.add_parser("plan", help="print the run's decided operations as JSON, write nothing")
+    sub.add_parser("apply", help="carry out a plan, rejecting ops whose files changed since"
+                   ).add_argument("plan")
+    sub.add_parser("shard-merge", help="fold the shards' state overlays into the shared state")
+    au = sub.add_parser("audit", help="JSON report of duplicates, orphans and shared files in DEST")
+    au.add_argument("--jobs", type=int, default=1, help="genre rooms walked in parallel")
+    au.add_argument("--no-content", dest="content", action="store_false",
+                    help="skip fingerprinting same-size files")
+    au.add_argument("--unowned", action="store_true", help="list unowned epubs, not just count")
+    ln = sub.add_parser("links",
+                        help="JSON inode -> paths map of every hardlink under DEST and LIB")
+    ln.add_argument("roots", nargs="*", help="more roots to scan, e.g. the torrent folder")
+    ln.add_argument("--jobs", type=int, default=1, help="top-level folders walked in parallel")
+    ln.add_argument("--min", type=int, default=3, dest="min_nlink",
+                    help="report inodes at this many links or more (default 3)")
+    pd = sub.add_parser("profile-diff", help="compare two PROFILE outputs (normal run first)")
+    pd.add_argument("a")
+    pd.add_argument("b")
+    pd.add_argument("--top", type=int, default=25)
+    args = ap.parse_args()
+    if args.cmd == "profile-diff":
+        sys.exit(profile_diff(args.a, args.b, args.top))
+    if args.cmd == "audit":
+        sys.exit(audit(args.jobs, args.content, args.unowned))
+    if args.cmd == "links":
+        sys.exit(links_scan(args.roots, args.jobs, args.min_nlink))
+    if args.cmd == "shard-merge":
+        sys.exit(shard_merge())
+    if args.cmd == "plan":
+        st = open_state(dry=True)
+        json.dump(make_plan(st), sys.stdout, indent=1, ensure_ascii=False)
+        print()
+        sys.exit(0)
+    if args.cmd == "apply":
+        sys.exit(apply_plan(args.plan))
+    if args.cmd == "verify-backend":
+        sys.exit(verify_backend())
+    if args.cmd == "state":
+        sys.exit(state_command(args))
+    if args.watch:
+        watch()
+    else:
+        main()
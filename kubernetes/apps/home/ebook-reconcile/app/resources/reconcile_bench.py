@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""Benchmark reconcile.py against a synthetic library before a bulk import.
+
+Generates a fake Calibre library (epubs + a calibre-shaped metadata.db) and a
+partly curated ABS tree of any size, stubs `calibredb` with a local script that
+answers `list --for-machine` from a JSON fixture, then times reconcile through
+the scenarios that matter in production:
+
+  cold      empty state, half-curated tree   (first run / state volume lost)
+  warm      nothing changed, full sweep      (the steady-state tick)
+  bake      every Calibre mtime moved, bytes unchanged   (after embed-nightly)
+  bulk-new  10% more books tagged at once    (a bulk tagging session)
+
+Each scenario reports wall time, syscalls, bytes read/written and peak RSS.
+Syscalls come from an instrumented os layer wrapped around the reconcile
+process (or `strace -c` with --strace, where strace exists); bytes come from
+/proc/self/io. Results are written as JSON, and --baseline prints the change
+against an earlier result file so regressions are visible. --scan points
+ABS_URL at a local stand-in and records how many rescan requests each scenario
+would have sent AudiobookShelf.
+
+--durability adds one recopy run per DURABILITY mode (none, file, batch).
+Each starts from the curated tree with empty state, so every tagged book is
+copied again. It shows what each guarantee costs in wall time and fsyncs.
+
+--memory 10000,50000,100000 measures what a run holds in memory rather than
+its time. For each size it compares peak RSS after fetch_books() with the old
+read-everything-then-json.loads path, over the same stub output. Only
+metadata is generated for it, no epubs, so large sizes stay cheap.
+
+The stub answers in milliseconds where the real calibredb takes seconds to
+start, so these numbers isolate reconcile's own cost. Point --root at the NFS
+export to measure what the export actually costs.
+
+    python3 reconcile_bench.py --books 10000 --root /tmp/bench --out bench.json
+    python3 reconcile_bench.py --books 10000 --baseline bench.json --out new.json
+    python3 reconcile_bench.py --books 1000 --env COMPARE=md5 --env WORKERS=1
+    python3 reconcile_bench.py --memory 10000,50000,100000
+"""
+import argparse
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RECONCILE = os.path.join(HERE, "reconcile.py")
+TAG = "→abs"
+GENRES = ["Fantasy", "Science Fiction", "Romance", "Mystery", "Thriller", "Horror",
+          "Historical", "Non-Fiction", "Young Adult", "LitRPG", "Literary", "Humour"]
+WORDS = ("shadow empire veil crown storm ember glass river iron night blood queen "
+         "wolf star silent broken last hidden winter dragon song ash throne sea").split()
+SCENARIOS = ["cold", "warm", "bake", "bulk-new"]
+DURABILITY_MODES = ["none", "file", "batch"]
+
+# Calibre's schema, reduced to the tables reconcile's sqlite backend reads.
+SCHEMA = """
+CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, series_index REAL, path TEXT,
+                    last_modified TIMESTAMP);
+CREATE TABLE authors (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE books_authors_link (id INTEGER PRIMARY KEY, book INTEGER, author INTEGER);
+CREATE TABLE series (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE books_series_link (id INTEGER PRIMARY KEY, book INTEGER, series INTEGER);
+CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE books_tags_link (id INTEGER PRIMARY KEY, book INTEGER, tag INTEGER);
+CREATE TABLE data (id INTEGER PRIMARY KEY, book INTEGER, format TEXT, name TEXT);
+CREATE TABLE custom_columns (id INTEGER PRIMARY KEY, label TEXT, is_multiple BOOL,
+                             normalized BOOL);
+CREATE TABLE custom_column_1 (id INTEGER PRIMARY KEY, value TEXT);
+CREATE TABLE books_custom_column_1_link (id INTEGER PRIMARY KEY, book INTEGER, value INTEGER);
+INSERT INTO custom_columns VALUES (1, 'genre', 0, 1);
+"""
+
+# `calibredb --with-library LIB list --search S --fields F --for-machine`,
+# answered from books.json. Honours the tag and last_modified parts of the
+# search reconcile sends; nothing else.
+STUB = r'''#!{python}
+import json, re, sys
+books = json.load(open({fixture!r}, encoding="utf-8"))
+search = sys.argv[sys.argv.index("--search") + 1] if "--search" in sys.argv else ""
+tag = re.search(r'tag:"([^"]*)"', search)
+since = re.search(r'last_modified:">=([0-9-]+)"', search)
+out = []
+for b in books:
+    if tag and not any(tag.group(1).casefold() in t.casefold() for t in b["tags"]):
+        continue
+    if since and b["last_modified"][:10] < since.group(1):
+        continue
+    out.append({{k: v for k, v in b.items() if k != "tags" and v is not None}})
+json.dump(out, sys.stdout, ensure_ascii=False)
+'''
+
+# Runs reconcile.py in-process with the os layer counted, then reports.
+RUNNER = r'''
+import builtins, io, json, os, resource, runpy, sys
+counts = {}
+def wrap(mod, name):
+    real = getattr(mod, name)
+    def counted(*a, **kw):
+        counts[name] = counts.get(name, 0) + 1
+        return real(*a, **kw)
+    setattr(mod, name, counted)
+for name in ("stat", "lstat", "scandir", "listdir", "mkdir", "rmdir", "remove", "replace",
+             "rename", "utime", "chmod", "fsync", "copy_file_range", "sendfile", "open"):
+    if hasattr(os, name):
+        wrap(os, name)
+real_open = builtins.open
+def counted_open(*a, **kw):
+    counts["open()"] = counts.get("open()", 0) + 1
+    return real_open(*a, **kw)
+builtins.open = io.open = counted_open
+sys.argv = [sys.argv[1]] + sys.argv[3:]
+report = os.environ.pop("BENCH_REPORT")
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+finally:
+    proc_io = {}
+    try:
+        with real_open("/proc/self/io") as f:
+            proc_io = dict((k, int(v)) for k, v in (l.split(": ") for l in f))
+    except OSError:
+        pass
+    # VmHWM, not ru_maxrss: Linux carries ru_maxrss across exec, so it would
+    # report the bench process that forked us once its fixture outgrew reconcile.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with real_open("/proc/self/status") as f:
+            peak = next(int(l.split()[1]) for l in f if l.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        pass
+    with real_open(report, "w") as f:
+        json.dump({"calls": counts, "io": proc_io, "peak_rss_kb": peak}, f)
+'''
+
+
+# Peak RSS of one book listing, parsed either by reconcile (slotted records
+# streamed off the pipe) or the way it used to be (all of stdout, then json.loads).
+MEMORY = r'''
+import json, runpy, subprocess, sys
+def hwm():
+    with open("/proc/self/status") as f:
+        return next(int(l.split()[1]) for l in f if l.startswith("VmHWM:"))
+rc = runpy.run_path(sys.argv[1], run_name="reconcile")
+before = hwm()
+if sys.argv[2] == "dicts":
+    books = json.loads(subprocess.run(
+        [rc["CALIBREDB"], "--with-library", rc["LIB"], "list", "--search",
+         f'tag:"{rc["TAG"]}"', "--fields", rc["FIELDS"], "--for-machine"],
+        capture_output=True, text=True, check=True).stdout)
+else:
+    books = rc["fetch_books"]()
+print(json.dumps({"books": len(books), "import_kb": before, "peak_kb": hwm()}))
+'''
+
+
+def _epub(path, title, rng):
+    """A small but real epub: a ZIP with mimetype, OPF and one chapter."""
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip")
+        z.writestr("OEBPS/content.opf", f"<package><title>{title}</title></package>")
+        z.writestr("OEBPS/ch1.xhtml", " ".join(rng.choices(WORDS, k=400)))
+
+
+def _title(rng):
+    return " ".join(w.capitalize() for w in rng.sample(WORDS, rng.randint(1, 4)))
+
+
+def generate(root, n, seed=1, start_id=1, tagged=0.9, curated=0.5, files=True):
+    """Create/extend the fake library under root; returns the new fixture records.
+
+    Fan-out follows the real tree: ~12 genre rooms, authors drawn Zipf-like so
+    a few own long series (the 40+ book folders), series of varying length
+    with ~5% fractional indexes, ~20% standalones, ~5% collaborations of which
+    some pairs are standing partnerships with their own folder. `curated` of
+    the books already sit in the tree under hand-typed names (lower-cased
+    titles, different index prefixes) as byte-identical older copies.
+    files=False writes only the records: no epubs, no tree.
+    """
+    rng = random.Random(seed + start_id)
+    lib, dest = os.path.join(root, "lib"), os.path.join(root, "dest")
+    os.makedirs(lib, exist_ok=True)
+    os.makedirs(dest, exist_ok=True)
+    n_authors = max(3, n // 8)
+    authors = [f"{rng.choice(WORDS).capitalize()} {rng.choice(WORDS).capitalize()}son {i}"
+               for i in range(n_authors)]
+    weights = [1 / (i + 1) for i in range(n_authors)]
+    genre_of = {a: rng.choice(GENRES) for a in authors}
+    sagas = {a: [f"{_title(rng)} Saga" for _ in range(rng.randint(1, 4))] for a in authors}
+    partners = {}
+    books = []
+    old = time.time() - 30 * 86400
+    for bid in range(start_id, start_id + n):
+        author = rng.choices(authors, weights)[0]
+        names = author
+        if rng.random() < 0.05:
+            other = rng.choice(authors)
+            if other != author:
+                names = f"{author} & {other}"
+                if partners.setdefault(names, rng.random() < 0.3):
+                    os.makedirs(os.path.join(dest, rng.choice(GENRES), names), exist_ok=True)
+        title = _title(rng)
+        series, idx = None, 0.0
+        if rng.random() > 0.2:
+            series = rng.choice(sagas[author])
+            idx = float(rng.randint(1, 45))
+            if rng.random() < 0.05:
+                idx += rng.choice((0.5, 0.6))
+        folder = os.path.join(lib, author, f"{title} ({bid})")
+        src = os.path.join(folder, f"{title} - {author}.epub")
+        genre = genre_of[author]
+        if files:
+            os.makedirs(folder, exist_ok=True)
+            _epub(src, title, rng)
+        if files and rng.random() < curated:
+            parts = [dest, genre, author] + ([series] if series else [])
+            name = title.lower() if rng.random() < 0.3 else title
+            leaf = f"{int(idx):d} - {name}" if series else name
+            os.makedirs(os.path.join(*parts, leaf), exist_ok=True)
+            dst = os.path.join(*parts, leaf, f"{name}.epub")
+            shutil.copyfile(src, dst)
+            os.utime(dst, (old, old))
+        books.append({
+            "id": bid, "title": title, "authors": names, "series": series,
+            "series_index": idx, "*genre": genre, "formats": [src],
+            "last_modified": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()),
+            "tags": [TAG] if rng.random() < tagged else ["to-read"],
+        })
+    return books
+
+
+def write_fixture(root, books):
+    with open(os.path.join(root, "books.json"), "w", encoding="utf-8") as f:
+        json.dump(books, f, ensure_ascii=False)
+    db_path = os.path.join(root, "lib", "metadata.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path)
+    db.executescript(SCHEMA)
+    ids = {}
+
+    def ref(table, value):
+        col = "value" if table.startswith("custom") else "name"
+        if (table, value) not in ids:
+            ids[table, value] = db.execute(
+                f"INSERT INTO {table} ({col}) VALUES (?)", (value,)).lastrowid
+        return ids[table, value]
+
+    for b in books:
+        src = b["formats"][0]
+        db.execute("INSERT INTO books VALUES (?, ?, ?, ?, ?)", (
+            b["id"], b["title"], b["series_index"],
+            os.path.relpath(os.path.dirname(src), os.path.join(root, "lib")),
+            b["last_modified"].replace("T", " ")))
+        for a in b["authors"].split(" & "):
+            db.execute("INSERT INTO books_authors_link (book, author) VALUES (?, ?)",
+                       (b["id"], ref("authors", a.replace(",", "|"))))
+        if b["series"]:
+            db.execute("INSERT INTO books_series_link (book, series) VALUES (?, ?)",
+                       (b["id"], ref("series", b["series"])))
+        db.execute("INSERT INTO books_custom_column_1_link (book, value) VALUES (?, ?)",
+                   (b["id"], ref("custom_column_1", b["*genre"])))
+        for t in b["tags"]:
+            db.execute("INSERT INTO books_tags_link (book, tag) VALUES (?, ?)",
+                       (b["id"], ref("tags", t)))
+        db.execute("INSERT INTO data (book, format, name) VALUES (?, 'EPUB', ?)",
+                   (b["id"], os.path.splitext(os.path.basename(src))[0]))
+    db.commit()
+    db.close()
+    stub = os.path.join(root, "calibredb")
+    with open(stub, "w") as f:
+        f.write(STUB.format(python=sys.executable, fixture=os.path.join(root, "books.json")))
+    os.chmod(stub, 0o755)
+
+
+class _ScanStandIn(http.server.BaseHTTPRequestHandler):
+    """Accepts ABS rescan requests and counts them by route."""
+    hits = {}
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        route = "scan" if self.path.endswith("/scan") else "watcher"
+        self.hits[route] = self.hits.get(route, 0) + 1
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *a):
+        pass
+
+
+def run(root, name, env_extra, use_strace):
+    """One reconcile run, measured. Returns the scenario's result record."""
+    report = os.path.join(root, f"report-{name}.json")
+    env = {**os.environ, "LIB": os.path.join(root, "lib"), "DEST": os.path.join(root, "dest"),
+           "STATE": os.path.join(root, "state", "abs_paths.json"),
+           "CALIBREDB": os.path.join(root, "calibredb"), "TAG": TAG, "FULL": "1",
+           "BENCH_REPORT": report, **env_extra}
+    cmd = [sys.executable, "-c", RUNNER, RECONCILE, "--"]
+    strace_out = os.path.join(root, f"strace-{name}.txt")
+    if use_strace:
+        cmd = ["strace", "-f", "-c", "-o", strace_out] + cmd
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if proc.returncode:
+        sys.exit(f"{name}: reconcile failed\n{proc.stderr}")
+    with open(report) as f:
+        rep = json.load(f)
+    result = {
+        "wall_s": round(wall, 3),
+        "syscalls": sum(rep["calls"].values()),
+        "calls": rep["calls"],
+        "bytes_read": rep["io"].get("rchar"),
+        "bytes_written": rep["io"].get("wchar"),
+        "peak_rss_kb": rep["peak_rss_kb"],
+        "summary": next((l for l in proc.stdout.splitlines() if l.startswith("done")), ""),
+    }
+    if use_strace:
+        result["strace_syscalls"] = _strace_total(strace_out)
+    if "ABS_URL" in env_extra:
+        result["scan_requests"] = dict(_ScanStandIn.hits)
+        _ScanStandIn.hits.clear()
+    return result
+
+
+def _tree_files(root):
+    return {os.path.join(d, f) for d, _, fs in os.walk(os.path.join(root, "dest")) for f in fs}
+
+
+def _unplace(root, curated):
+    """Back to the curated tree: drop every file reconcile placed, and its state."""
+    for p in _tree_files(root) - curated:
+        os.remove(p)
+    shutil.rmtree(os.path.join(root, "state"), ignore_errors=True)
+
+
+def memory(root, sizes, seed):
+    """Peak RSS of the book listing at each size, streamed vs. json.loads."""
+    env = {**os.environ, "LIB": os.path.join(root, "lib"), "DEST": os.path.join(root, "dest"),
+           "STATE": os.path.join(root, "state", "abs_paths.json"),
+           "CALIBREDB": os.path.join(root, "calibredb"), "TAG": TAG}
+    results = {}
+    for n in sizes:
+        write_fixture(root, generate(root, n, seed, files=False))
+        row = {}
+        for how in ("records", "dicts"):
+            proc = subprocess.run([sys.executable, "-c", MEMORY, RECONCILE, how],
+                                  env=env, capture_output=True, text=True)
+            if proc.returncode:
+                sys.exit(f"memory {n}: {how} failed\n{proc.stderr}")
+            rep = json.loads(proc.stdout)
+            row[how] = {"books": rep["books"], "peak_rss_kb": rep["peak_kb"],
+                        "listing_kb": rep["peak_kb"] - rep["import_kb"]}
+        results[n] = row
+        r, d = row["records"], row["dicts"]
+        print(f"memory {n:>8,} books  records: +{r['listing_kb']:,}KiB "
+              f"({1024 * r['listing_kb'] / max(1, r['books']):.0f}B/book)  "
+              f"json.loads: +{d['listing_kb']:,}KiB "
+              f"({1024 * d['listing_kb'] / max(1, d['books']):.0f}B/book)")
+    return results
+
+
+def _strace_total(path):
+    with open(path) as f:
+        for line in f:
+            if line.rstrip().endswith("total"):
+                return int(line.split()[2])
+    return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--books", type=int, default=10000)
+    ap.add_argument("--root", help="scratch directory (default: a fresh temp dir)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                    help="extra reconcile environment, e.g. COMPARE=md5")
+    ap.add_argument("--strace", action="store_true", help="also count syscalls with strace -c")
+    ap.add_argument("--out", default="reconcile-bench.json")
+    ap.add_argument("--baseline", help="earlier --out file to compare against")
+    ap.add_argument("--keep", action="store_true", help="leave the scratch tree behind")
+    ap.add_argument("--scan", action="store_true",
+                    help="count ABS rescan requests against a local stand-in")
+    ap.add_argument("--durability", action="store_true",
+                    help="also time a full recopy under each DURABILITY mode")
+    ap.add_argument("--memory", metavar="N,N,...",
+                    help="instead of the scenarios: peak RSS of the book listing at each size")
+    args = ap.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="reconcile-bench-")
+    if os.path.exists(os.path.join(root, "books.json")):
+        sys.exit(f"{root} already holds a bench library; pick an empty --root")
+    env_extra = dict(kv.split("=", 1) for kv in args.env)
+    if args.memory:
+        sizes = [int(n) for n in args.memory.split(",")]
+        out = {"memory": memory(root, sizes, args.seed), "seed": args.seed,
+               "python": platform.python_version(), "host": platform.node(),
+               "when": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        with open(args.out, "w") as f:
+            json.dump(out, f, indent=2)
+        print(f"results -> {args.out}")
+        if not args.root and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+        return
+    if args.scan:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _ScanStandIn)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        env_extra.update(ABS_URL=f"http://127.0.0.1:{server.server_port}",
+                         ABS_LIBRARY="bench")
+    wanted = args.scenarios.split(",")
+    t0 = time.perf_counter()
+    books = generate(root, args.books, args.seed)
+    write_fixture(root, books)
+    curated = _tree_files(root)
+    print(f"generated {args.books} books in {time.perf_counter() - t0:.1f}s under {root}")
+
+    results = {}
+    runs = [n for n in SCENARIOS if n in wanted]
+    if args.durability:
+        runs += [f"durability-{m}" for m in DURABILITY_MODES]
+    for name in runs:
+        if name == "bake":         # embed-nightly: new mtimes, identical bytes
+            later = time.time()
+            for b in books:
+                os.utime(b["formats"][0], (later, later))
+        elif name == "bulk-new":
+            books += generate(root, max(1, args.books // 10), args.seed,
+                              start_id=len(books) + 1, tagged=1.0, curated=0.0)
+            write_fixture(root, books)
+        extra = env_extra
+        if name.startswith("durability-"):
+            _unplace(root, curated)
+            extra = {**env_extra, "DURABILITY": name.split("-", 1)[1]}
+        results[name] = run(root, name, extra, args.strace)
+        r = results[name]
+        print(f"{name:16} {r['wall_s']:8.2f}s  syscalls={r['syscalls']:,}  "
+              f"read={r['bytes_read'] or 0:,}B  rss={r['peak_rss_kb']:,}KiB"
+              + (f"  abs={r['scan_requests']}" if "scan_requests" in r else ""))
+
+    out = {"books": args.books, "seed": args.seed, "env": env_extra,
+           "python": platform.python_version(), "host": platform.node(),
+           "when": time.strftime("%Y-%m-%dT%H:%M:%S"), "scenarios": results}
+    with open(args.out, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"results -> {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)["scenarios"]
+        for name, r in results.items():
+            if name not in base:
+                continue
+            deltas = []
+            for k in ("wall_s", "syscalls", "bytes_read", "peak_rss_kb"):
+                old, new = base[name].get(k), r.get(k)
+                if old and new is not None:
+                    deltas.append(f"{k} {100 * (new - old) / old:+.0f}%")
+            print(f"vs baseline {name:16} " + "  ".join(deltas))
+
+    if not args.root and not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()